@@ -0,0 +1,147 @@
+# hbase_common.py
+# Shared HBase Thrift settings, row key salting and scan helpers for the
+# loader, query, analytics and chart scripts
+
+import functools
+import happybase
+import itertools
+import queue
+import threading
+import zlib
+
+# --- HBase Connection ---
+HBASE_HOST = 'localhost'
+HBASE_PORT = 9090
+HBASE_POOL_SIZE = 16
+
+# --- Thrift wire format ---
+# Must match how the Thrift server was started. The docker-compose
+# dajobe/hbase service runs the stock server (buffered transport, binary
+# protocol). If you start Thrift with `hbase thrift start -f -c` (or set
+# hbase.regionserver.thrift.framed/compact=true), switch these to
+# 'framed'/'compact' for smaller frames on the wire.
+HBASE_TRANSPORT = 'buffered'
+HBASE_PROTOCOL = 'binary'
+
+@functools.lru_cache(maxsize=1)
+def get_pool():
+    """
+    Return the process-wide HBase Thrift connection pool, creating it on
+    first use (raises if HBase can't be reached).
+    
+    Callers borrow a connection with `with pool.connection() as connection:`
+    instead of opening a new Thrift connection per call.
+    """
+    return happybase.ConnectionPool(
+        size=HBASE_POOL_SIZE,
+        host=HBASE_HOST,
+        port=HBASE_PORT,
+        timeout=60000,
+        transport=HBASE_TRANSPORT,
+        protocol=HBASE_PROTOCOL
+    )
+
+
+# --- Row key salting ---
+# Session row keys start with a one-hex-digit salt bucket; changing this
+# means reloading the table
+SALT_BUCKETS = 16
+
+
+def row_key_salt(user_id):
+    """
+    Salt bucket for a user, as a single hex digit.
+    
+    Uses crc32 rather than hash() so the bucket is stable across processes
+    (hash() on str is randomized per interpreter run).
+    """
+    return f"{zlib.crc32(user_id.encode()) % SALT_BUCKETS:x}"
+
+
+def scan_salted_sample(table, limit, columns=None, batch_size=1000):
+    """
+    Scan up to limit rows, sampled evenly across the salt buckets and
+    projected to the given columns.
+    
+    The first key range alone is a single salt bucket, not a fair sample,
+    so each bucket is scanned by its row prefix for an equal share.
+    """
+    per_bucket = max(limit // SALT_BUCKETS, 1)
+    return itertools.chain.from_iterable(
+        table.scan(row_prefix=f"{bucket:x}_".encode(), limit=per_bucket,
+                   columns=columns, batch_size=batch_size)
+        for bucket in range(SALT_BUCKETS)
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_cached(value):
+    """
+    Decode bytes from a low-cardinality column (conversion status, device
+    type/browser, referrer, geo state).
+    
+    These columns repeat a handful of values across every row, so caching
+    the decoded str avoids allocating a new string per row. Decode columns
+    with thousands of distinct values (geo city, ip address) directly; they
+    would only evict the entries worth keeping from the shared 1024-entry
+    cache.
+    """
+    return value.decode()
+
+
+def prefetch(rows, chunk_size=1000, buffer_chunks=2):
+    """
+    Iterate over scan results while a background thread fetches ahead.
+    
+    The scanner is drained in chunks of chunk_size rows into a bounded
+    queue, so the next Thrift round-trip runs while the caller is still
+    processing the current chunk. The scan's connection must not be used
+    by anything else until iteration finishes.
+    """
+    chunks = queue.Queue(maxsize=buffer_chunks)
+    stop = threading.Event()
+    done = object()
+    
+    def put(item):
+        # Give up if the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def fetch():
+        # Always end the stream with done or the error, whatever stops the
+        # fetcher, or the consumer would block on chunks.get() forever
+        end = done
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if chunk:
+                put(chunk)
+        except BaseException as e:
+            end = e
+        finally:
+            put(end)
+    
+    fetcher = threading.Thread(target=fetch, daemon=True)
+    fetcher.start()
+    
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+    finally:
+        stop.set()
+        fetcher.join()
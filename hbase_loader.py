@@ -1,25 +1,34 @@
 
 
-import happybase
-import json
+import ijson
+import msgpack
+import orjson
+import argparse
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from hbase_common import get_pool, row_key_salt
 
 # --- HBase Connection ---
-HBASE_HOST = 'localhost'
-HBASE_PORT = 9090
 TABLE_NAME = 'sessions'
+LOADER_WORKERS = 8
+BATCH_SIZE = 5000
 
-def connect_to_hbase():
-    """Connect to HBase via Thrift"""
-    try:
-        connection = happybase.Connection(HBASE_HOST, HBASE_PORT)
-        connection.open()
-        print(" Connected to HBase successfully!")
-        return connection
-    except Exception as e:
-        print(f" Failed to connect to HBase: {e}")
-        return None
+# --- Bulk load (ImportTsv + completebulkload) ---
+# HBASE_CMD runs the hbase CLI; with the docker-compose setup use
+# ['docker', 'exec', 'hbase', 'hbase']. BULKLOAD_DIR must be a path the
+# hbase command can read (e.g. a mounted volume).
+HBASE_CMD = ['hbase']
+BULKLOAD_DIR = 'bulkload'
 
+# Column order of the TSV export, after the row key
+SESSION_COLUMNS = (
+    b'session_info:session_id', b'session_info:duration', b'session_info:conversion_status',
+    b'session_info:referrer', b'session_info:start_time', b'session_info:end_time',
+    b'device:type', b'device:os', b'device:browser',
+    b'geo:city', b'geo:state', b'geo:country', b'geo:ip_address',
+    b'activity:viewed_products', b'activity:cart_contents', b'activity:page_views_count'
+)
 
 def create_sessions_table(connection):
     """
@@ -27,14 +36,20 @@ def create_sessions_table(connection):
     
     Schema Design:
     ==============
-    Row Key: user_id + "_" + timestamp (e.g., "user_000042_2025-03-12T14:37:22")
-             This allows efficient scanning of all sessions for a specific user.
+    Row Key: salt + "_" + user_id + "_" + timestamp (e.g., "7_user_000042_2025-03-12T14:37:22")
+             The salt spreads writes over hbase_common.SALT_BUCKETS key ranges, while all
+             sessions for a specific user still sit together in one bucket.
     
     Column Families:
     - session_info: Basic session metadata (duration, conversion status, referrer)
     - device: Device information (type, os, browser)
     - geo: Geographic data (city, state, country, ip)
     - activity: Browsing activity (viewed products, cart contents)
+    
+    viewed_products and cart_contents are stored MessagePack-encoded by
+    the Thrift load, and JSON-encoded by --bulk-load (ImportTsv cannot
+    carry MessagePack's raw tabs and newlines). Readers tell the two apart
+    by the first byte, see hbase_queries.decode_activity.
     """
     
     print("\n--- Connecting to HBase Table ---")
@@ -56,25 +71,113 @@ def generate_row_key(user_id, start_time):
     """
     Generate row key for efficient querying.
     
-    Format: user_id + "_" + timestamp
-    Example: user_000042_2025-03-12T14:37:22
+    Format: salt + "_" + user_id + "_" + timestamp
+    Example: 7_user_000042_2025-03-12T14:37:22
     
     Why this design?
     - Rows are sorted by key in HBase
-    - All sessions for same user are stored together
-    - Can scan by user_id prefix to get all user's sessions
+    - The salt prefix spreads new sessions across regions instead of
+      hot-spotting the tail region, and lets global scans run per bucket
+    - All sessions for same user share a salt, so they are stored together
+    - Can scan by salt + user_id prefix to get all user's sessions
     - Timestamp allows ordering sessions chronologically
     """
-    return f"{user_id}_{start_time}"
+    return f"{row_key_salt(user_id)}_{user_id}_{start_time}"
+
+
+def pack_activity(value):
+    """MessagePack-encode an activity list or map for a Thrift put"""
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def build_session_row(session, encode_activity=pack_activity):
+    """
+    Convert a parsed session record into an HBase row key and column dict.
+    
+    encode_activity serializes viewed_products and cart_contents; the TSV
+    export passes orjson.dumps so each row is encoded once, as JSON.
+    """
+    
+    # Generate row key
+    row_key = generate_row_key(session['user_id'], session['start_time'])
+    
+    device = session['device_profile']
+    geo = session['geo_data']
+    
+    # Prepare data for each column family (a constant-key dict literal is
+    # built in one step and is faster than dict(zip(SESSION_COLUMNS, ...)))
+    data = {
+        # Session info
+        b'session_info:session_id': session['session_id'].encode(),
+        b'session_info:duration': b'%d' % session['duration_seconds'],
+        b'session_info:conversion_status': session['conversion_status'].encode(),
+        b'session_info:referrer': session['referrer'].encode(),
+        b'session_info:start_time': session['start_time'].encode(),
+        b'session_info:end_time': session['end_time'].encode(),
+        
+        # Device info
+        b'device:type': device['type'].encode(),
+        b'device:os': device['os'].encode(),
+        b'device:browser': device['browser'].encode(),
+        
+        # Geo info
+        b'geo:city': geo['city'].encode(),
+        b'geo:state': geo['state'].encode(),
+        b'geo:country': geo['country'].encode(),
+        b'geo:ip_address': geo['ip_address'].encode(),
+        
+        # Activity info
+        b'activity:viewed_products': encode_activity(session['viewed_products']),
+        b'activity:cart_contents': encode_activity(session['cart_contents']),
+        b'activity:page_views_count': b'%d' % len(session['page_views'])
+    }
+    
+    return row_key.encode(), data
+
+
+def write_batch(pool, rows):
+    """Write one chunk of rows to HBase using a connection borrowed from the pool"""
+    with pool.connection() as connection:
+        table = connection.table(TABLE_NAME)
+        # Batch flushes itself every BATCH_SIZE puts and on exit
+        with table.batch(batch_size=BATCH_SIZE, transaction=False) as batch:
+            for row_key, data in rows:
+                batch.put(row_key, data)
+    return len(rows)
+
+
+def wait_for_batches(pending, max_pending):
+    """Block until fewer than max_pending batches are in flight; return rows written"""
+    written = 0
+    while pending and len(pending) >= max_pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            written += future.result()
+    return written
+
+
+def find_session_files(data_dir):
+    """Return the sorted names of all sessions_*.json files in data_dir"""
+    return sorted(
+        entry.name for entry in os.scandir(data_dir)
+        if entry.is_file() and entry.name.startswith('sessions_') and entry.name.endswith('.json')
+    )
 
 
-def load_sessions(connection, table, data_dir="."):
-    """Load session data from JSON files into HBase"""
+def load_sessions(pool, data_dir=".", num_workers=LOADER_WORKERS):
+    """
+    Load session data from JSON files into HBase.
+    
+    The main thread parses sessions and groups them into chunks; a pool of
+    writer threads sends each chunk as its own batch, so Thrift round-trips
+    overlap with parsing. At most 2 * num_workers chunks are held in memory.
+    """
     
     print("\n--- Loading Sessions into HBase ---")
     
     # Find all session files
-    session_files = sorted([f for f in os.listdir(data_dir) if f.startswith('sessions_') and f.endswith('.json')])
+    session_files = find_session_files(data_dir)
     
     if not session_files:
         print(" No session files found!")
@@ -83,73 +186,112 @@ def load_sessions(connection, table, data_dir="."):
     print(f"Found {len(session_files)} session file(s): {session_files}")
     
     total_loaded = 0
-    batch_size = 1000
+    max_pending = num_workers * 2
+    pending = set()
     
-    for session_file in session_files:
-        filepath = os.path.join(data_dir, session_file)
-        print(f"\nLoading {session_file}...")
-        
-        with open(filepath, 'r') as f:
-            sessions = json.load(f)
-        
-        print(f"   {len(sessions):,} sessions in file")
-        
-        # Use batch for faster loading
-        batch = table.batch()
-        batch_count = 0
-        
-        for i, session in enumerate(sessions):
-            # Generate row key
-            row_key = generate_row_key(session['user_id'], session['start_time'])
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for session_file in session_files:
+            filepath = os.path.join(data_dir, session_file)
+            print(f"\nLoading {session_file}...")
             
-            # Prepare data for each column family
-            data = {
-                # Session info
-                b'session_info:session_id': session['session_id'].encode(),
-                b'session_info:duration': str(session['duration_seconds']).encode(),
-                b'session_info:conversion_status': session['conversion_status'].encode(),
-                b'session_info:referrer': session['referrer'].encode(),
-                b'session_info:start_time': session['start_time'].encode(),
-                b'session_info:end_time': session['end_time'].encode(),
+            # Stream sessions one at a time instead of loading the whole array
+            with open(filepath, 'rb') as f:
+                sessions = ijson.items(f, 'item', use_float=True)
                 
-                # Device info
-                b'device:type': session['device_profile']['type'].encode(),
-                b'device:os': session['device_profile']['os'].encode(),
-                b'device:browser': session['device_profile']['browser'].encode(),
+                rows = []
+                file_count = 0
                 
-                # Geo info
-                b'geo:city': session['geo_data']['city'].encode(),
-                b'geo:state': session['geo_data']['state'].encode(),
-                b'geo:country': session['geo_data']['country'].encode(),
-                b'geo:ip_address': session['geo_data']['ip_address'].encode(),
+                for session in sessions:
+                    rows.append(build_session_row(session))
+                    file_count += 1
+                    
+                    # Hand a full chunk to the writer threads
+                    if len(rows) >= BATCH_SIZE:
+                        written = wait_for_batches(pending, max_pending)
+                        if written:
+                            total_loaded += written
+                            print(f"   Loaded {total_loaded:,} sessions...")
+                        pending.add(executor.submit(write_batch, pool, rows))
+                        rows = []
                 
-                # Activity info
-                b'activity:viewed_products': json.dumps(session['viewed_products']).encode(),
-                b'activity:cart_contents': json.dumps(session['cart_contents']).encode(),
-                b'activity:page_views_count': str(len(session['page_views'])).encode()
-            }
-            
-            # Put data
-            batch.put(row_key.encode(), data)
-            batch_count += 1
+                # Send remaining
+                if rows:
+                    pending.add(executor.submit(write_batch, pool, rows))
             
-            # Send batch
-            if batch_count >= batch_size:
-                batch.send()
-                total_loaded += batch_count
-                print(f"   Loaded {total_loaded:,} sessions...")
-                batch = table.batch()
-                batch_count = 0
+            print(f"   {file_count:,} sessions in file")
         
-        # Send remaining
-        if batch_count > 0:
-            batch.send()
-            total_loaded += batch_count
+        # Wait for all in-flight batches
+        total_loaded += wait_for_batches(pending, 1)
     
     print(f"\n Total sessions loaded: {total_loaded:,}")
     return total_loaded
 
 
+def export_sessions_tsv(data_dir, tsv_path):
+    """
+    Write every session as one TSV line: row key, then SESSION_COLUMNS values.
+    
+    MessagePack bytes may contain tabs or newlines, which ImportTsv cannot
+    escape, so the activity columns are written as JSON here instead.
+    Readers tell the two apart by the first byte (see hbase_queries).
+    """
+    
+    session_files = find_session_files(data_dir)
+    total = 0
+    
+    with open(tsv_path, 'wb') as out:
+        for session_file in session_files:
+            print(f"   Exporting {session_file}...")
+            with open(os.path.join(data_dir, session_file), 'rb') as f:
+                for session in ijson.items(f, 'item', use_float=True):
+                    row_key, data = build_session_row(session, encode_activity=orjson.dumps)
+                    out.write(row_key + b'\t' + b'\t'.join(data[c] for c in SESSION_COLUMNS) + b'\n')
+                    total += 1
+    
+    return total
+
+
+def bulk_load_sessions(data_dir=".", work_dir=BULKLOAD_DIR):
+    """
+    Bulk-load sessions by writing HFiles directly instead of going through Thrift.
+    
+    Steps:
+    1. Export sessions to a TSV file
+    2. ImportTsv with importtsv.bulk.output generates HFiles for the table
+    3. completebulkload moves the HFiles into the table's regions
+    """
+    
+    print("\n--- Bulk Loading Sessions into HBase ---")
+    
+    if not find_session_files(data_dir):
+        print(" No session files found!")
+        return 0
+    
+    os.makedirs(work_dir, exist_ok=True)
+    tsv_path = os.path.join(work_dir, 'sessions.tsv')
+    hfile_dir = os.path.join(work_dir, 'hfiles')
+    
+    total = export_sessions_tsv(data_dir, tsv_path)
+    print(f"   Exported {total:,} sessions to {tsv_path}")
+    
+    columns = ','.join(['HBASE_ROW_KEY'] + [c.decode() for c in SESSION_COLUMNS])
+    
+    print("   Generating HFiles with ImportTsv...")
+    subprocess.run(HBASE_CMD + [
+        'org.apache.hadoop.hbase.mapreduce.ImportTsv',
+        f'-Dimporttsv.columns={columns}',
+        f'-Dimporttsv.bulk.output={hfile_dir}',
+        TABLE_NAME,
+        tsv_path
+    ], check=True)
+    
+    print("   Loading HFiles with completebulkload...")
+    subprocess.run(HBASE_CMD + ['completebulkload', hfile_dir, TABLE_NAME], check=True)
+    
+    print(f"\n Total sessions bulk loaded: {total:,}")
+    return total
+
+
 def verify_data(table):
     """Verify data was loaded correctly"""
     
@@ -159,7 +301,8 @@ def verify_data(table):
     count = 0
     sample_row = None
     
-    for key, data in table.scan(limit=100):
+    # Sample display only needs the small families, not the activity blobs
+    for key, data in table.scan(limit=100, columns=[b'session_info', b'device']):
         count += 1
         if sample_row is None:
             sample_row = (key, data)
@@ -179,27 +322,38 @@ def verify_data(table):
 def main():
     """Main function"""
     
+    parser = argparse.ArgumentParser(description="Load session data into HBase")
+    parser.add_argument('--bulk-load', action='store_true',
+                        help="write HFiles with ImportTsv instead of Thrift batch puts")
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("   HBase Data Loader for E-commerce Sessions")
     print("=" * 60)
     
     # Connect
-    connection = connect_to_hbase()
-    if connection is None:
-        return
-    
-    # Create table
-    table = create_sessions_table(connection)
-    if table is None:
-        connection.close()
+    try:
+        pool = get_pool()
+        print(" Connected to HBase successfully!")
+    except Exception as e:
+        print(f" Failed to connect to HBase: {e}")
         return
     
-    # Load data
-    data_dir = r"D:\Patrick\AUCA\SEM3\bigdatanalytics\ecommerce_project\raw_data\session"
-    total = load_sessions(connection, table, data_dir)
-    
-    # Verify
-    verify_data(table)
+    with pool.connection() as connection:
+        # Create table
+        table = create_sessions_table(connection)
+        if table is None:
+            return
+        
+        # Load data
+        data_dir = r"D:\Patrick\AUCA\SEM3\bigdatanalytics\ecommerce_project\raw_data\session"
+        if args.bulk_load:
+            total = bulk_load_sessions(data_dir)
+        else:
+            total = load_sessions(pool, data_dir)
+        
+        # Verify
+        verify_data(table)
     
     # Summary
     print("\n" + "=" * 60)
@@ -208,11 +362,9 @@ def main():
     print(f" Table created: {TABLE_NAME}")
     print(f" Sessions loaded: {total:,}")
     print(f" Column families: session_info, device, geo, activity")
-    print("\nRow Key Design: user_id + '_' + timestamp")
-    print("Example: user_000042_2025-03-12T14:37:22")
+    print("\nRow Key Design: salt + '_' + user_id + '_' + timestamp")
+    print("Example: 7_user_000042_2025-03-12T14:37:22")
     
-    # Close
-    connection.close()
     print("\n HBase loading complete!")
 
 
@@ -1,22 +1,27 @@
-import happybase
+from hbase_common import decode_cached, get_pool, prefetch, row_key_salt, scan_salted_sample
 import json
+import msgpack
 
 # --- HBase Connection ---
-HBASE_HOST = 'localhost'
-HBASE_PORT = 9090
 TABLE_NAME = 'sessions'
+SCAN_BATCH_SIZE = 2000  # rows fetched per scanner round-trip
 
 
-def connect_to_hbase():
-    """Connect to HBase via Thrift"""
-    try:
-        connection = happybase.Connection(HBASE_HOST, HBASE_PORT)
-        connection.open()
-        print(" Connected to HBase successfully!\n")
-        return connection
-    except Exception as e:
-        print(f" Failed to connect to HBase: {e}")
-        return None
+def user_id_from_row_key(key):
+    """Extract user_id from a salt_user_XXXXXX_timestamp row key (bytes)"""
+    return key.split(b'_', 1)[1].rsplit(b'_', 1)[0].decode()
+
+
+def decode_activity(value):
+    """
+    Decode an activity:viewed_products / activity:cart_contents value.
+    
+    Thrift-loaded rows are MessagePack; bulk-loaded rows are JSON. A packed
+    list or map never starts with '[' or '{', so the first byte tells them apart.
+    """
+    if value[:1] in (b'[', b'{'):
+        return json.loads(value)
+    return msgpack.unpackb(value, raw=False)
 
 
 # ============================================================
@@ -28,8 +33,9 @@ def get_user_sessions(table, user_id, limit=10):
     Retrieve all sessions for a specific user.
     
     This demonstrates HBase's strength: efficient prefix scans.
-    Since row key = user_id + "_" + timestamp, all sessions for
-    a user are stored together and can be retrieved quickly.
+    Since row key = salt + "_" + user_id + "_" + timestamp and the salt
+    depends only on user_id, all sessions for a user are stored together
+    and can be retrieved quickly.
     """
     
     print("=" * 60)
@@ -38,23 +44,23 @@ def get_user_sessions(table, user_id, limit=10):
     print("Business Question: What is the browsing history of this user?\n")
     
     # Create row prefix for scanning
-    row_prefix = f"{user_id}_".encode()
+    row_prefix = f"{row_key_salt(user_id)}_{user_id}_".encode()
     
     sessions = []
     count = 0
     
-    for key, data in table.scan(row_prefix=row_prefix, limit=limit):
+    for key, data in table.scan(row_prefix=row_prefix, limit=limit, batch_size=SCAN_BATCH_SIZE):
         count += 1
         session = {
             'row_key': key.decode(),
             'session_id': data.get(b'session_info:session_id', b'').decode(),
             'start_time': data.get(b'session_info:start_time', b'').decode(),
             'duration': data.get(b'session_info:duration', b'').decode(),
-            'conversion_status': data.get(b'session_info:conversion_status', b'').decode(),
-            'device_type': data.get(b'device:type', b'').decode(),
-            'browser': data.get(b'device:browser', b'').decode(),
+            'conversion_status': decode_cached(data.get(b'session_info:conversion_status', b'')),
+            'device_type': decode_cached(data.get(b'device:type', b'')),
+            'browser': decode_cached(data.get(b'device:browser', b'')),
             'city': data.get(b'geo:city', b'').decode(),
-            'state': data.get(b'geo:state', b'').decode(),
+            'state': decode_cached(data.get(b'geo:state', b'')),
             'page_views': data.get(b'activity:page_views_count', b'').decode()
         }
         sessions.append(session)
@@ -80,9 +86,10 @@ def get_converted_sessions(table, limit=10):
     """
     Find sessions that resulted in conversions (purchases).
     
-    Note: This requires a full table scan since we're not
-    filtering by row key prefix. In production, you might
-    create a secondary index or use a different row key design.
+    Note: This still scans the table since we're not filtering by
+    row key prefix, but the conversion_status check runs on the
+    region server via a SingleColumnValueFilter, so only matching
+    rows (and only the projected columns) are sent back.
     """
     
     print("=" * 60)
@@ -91,29 +98,36 @@ def get_converted_sessions(table, limit=10):
     print("Business Question: Which sessions resulted in purchases?\n")
     
     converted = []
-    scanned = 0
     
-    for key, data in table.scan(limit=1000):  # Scan more to find converted
-        scanned += 1
-        status = data.get(b'session_info:conversion_status', b'').decode()
-        
-        if status == 'converted':
-            session = {
-                'row_key': key.decode(),
-                'user_id': key.decode().split('_')[0] + '_' + key.decode().split('_')[1],
-                'session_id': data.get(b'session_info:session_id', b'').decode(),
-                'start_time': data.get(b'session_info:start_time', b'').decode(),
-                'duration': data.get(b'session_info:duration', b'').decode(),
-                'device_type': data.get(b'device:type', b'').decode(),
-                'referrer': data.get(b'session_info:referrer', b'').decode()
-            }
-            converted.append(session)
-            
-            if len(converted) >= limit:
-                break
+    # The filtered column must be projected for the filter to see it
+    scan = table.scan(
+        filter="SingleColumnValueFilter('session_info', 'conversion_status', =, 'binary:converted', true, true)",
+        columns=[
+            b'session_info:conversion_status',
+            b'session_info:session_id',
+            b'session_info:start_time',
+            b'session_info:duration',
+            b'session_info:referrer',
+            b'device:type'
+        ],
+        limit=limit,
+        batch_size=SCAN_BATCH_SIZE
+    )
+    
+    for key, data in scan:
+        session = {
+            'row_key': key.decode(),
+            'user_id': user_id_from_row_key(key),
+            'session_id': data.get(b'session_info:session_id', b'').decode(),
+            'start_time': data.get(b'session_info:start_time', b'').decode(),
+            'duration': data.get(b'session_info:duration', b'').decode(),
+            'device_type': decode_cached(data.get(b'device:type', b'')),
+            'referrer': decode_cached(data.get(b'session_info:referrer', b''))
+        }
+        converted.append(session)
     
     # Display results
-    print(f"Scanned {scanned} rows, found {len(converted)} converted sessions:\n")
+    print(f"Found {len(converted)} converted sessions (filtered server-side):\n")
     print("-" * 100)
     print(f"{'User ID':<15} {'Session ID':<20} {'Start Time':<22} {'Duration':<10} {'Device':<10} {'Referrer':<15}")
     print("-" * 100)
@@ -151,7 +165,11 @@ def get_session_details(table, row_key):
     print("-" * 40)
     for key, value in row.items():
         family, column = key.decode().split(':')
-        print(f"  {family}.{column}: {value.decode()[:60]}...")
+        if key in (b'activity:viewed_products', b'activity:cart_contents'):
+            text = json.dumps(decode_activity(value))
+        else:
+            text = value.decode()
+        print(f"  {family}.{column}: {text[:60]}...")
     
     print()
     return row
@@ -176,8 +194,10 @@ def count_by_device(table, sample_size=5000):
     
     device_counts = {}
     
-    for key, data in table.scan(limit=sample_size, columns=[b'device:type']):
-        device = data.get(b'device:type', b'unknown').decode()
+    # Take an equal share of the sample from each salt bucket
+    scan = scan_salted_sample(table, sample_size, [b'device:type'], SCAN_BATCH_SIZE)
+    for key, data in prefetch(scan, chunk_size=SCAN_BATCH_SIZE):
+        device = decode_cached(data.get(b'device:type', b'unknown'))
         device_counts[device] = device_counts.get(device, 0) + 1
     
     total = sum(device_counts.values())
@@ -206,38 +226,39 @@ def main():
     print("=" * 60 + "\n")
     
     # Connect
-    connection = connect_to_hbase()
-    if connection is None:
+    try:
+        pool = get_pool()
+        print(" Connected to HBase successfully!\n")
+    except Exception as e:
+        print(f" Failed to connect to HBase: {e}")
         return
     
-    table = connection.table(TABLE_NAME)
-    
-    # First, find a user_id that exists in the data
-    print("Finding sample user IDs...\n")
-    sample_users = set()
-    sample_row_key = None
-    
-    for key, data in table.scan(limit=100):
-        row_key = key.decode()
-        # Extract user_id (format: user_XXXXXX_timestamp)
-        parts = row_key.split('_')
-        user_id = f"{parts[0]}_{parts[1]}"
-        sample_users.add(user_id)
-        if sample_row_key is None:
-            sample_row_key = row_key
-    
-    sample_user = list(sample_users)[0] if sample_users else "user_000001"
-    print(f"Sample users found: {list(sample_users)[:5]}")
-    print(f"Using user: {sample_user}\n")
-    
-    # Run queries
-    user_sessions = get_user_sessions(table, sample_user, limit=5)
-    converted = get_converted_sessions(table, limit=5)
-    
-    if sample_row_key:
-        details = get_session_details(table, sample_row_key)
-    
-    device_stats = count_by_device(table, sample_size=5000)
+    with pool.connection() as connection:
+        table = connection.table(TABLE_NAME)
+        
+        # First, find a user_id that exists in the data
+        print("Finding sample user IDs...\n")
+        sample_users = set()
+        sample_row_key = None
+        
+        # Only row keys are needed here, so skip the cell values entirely
+        for key, data in table.scan(limit=100, filter="FirstKeyOnlyFilter() AND KeyOnlyFilter()"):
+            sample_users.add(user_id_from_row_key(key))
+            if sample_row_key is None:
+                sample_row_key = key.decode()
+        
+        sample_user = list(sample_users)[0] if sample_users else "user_000001"
+        print(f"Sample users found: {list(sample_users)[:5]}")
+        print(f"Using user: {sample_user}\n")
+        
+        # Run queries
+        user_sessions = get_user_sessions(table, sample_user, limit=5)
+        converted = get_converted_sessions(table, limit=5)
+        
+        if sample_row_key:
+            details = get_session_details(table, sample_row_key)
+        
+        device_stats = count_by_device(table, sample_size=5000)
     
     # Summary
     print("=" * 60)
@@ -247,8 +268,6 @@ def main():
     print(f" Converted sessions query: Found {len(converted)} conversions")
     print(f" Device distribution query: {len(device_stats)} device types")
     
-    # Close
-    connection.close()
     print("\n All HBase queries completed!")
 
 
@@ -1,13 +1,10 @@
-from pymongo import MongoClient
+from hbase_common import HBASE_TRANSPORT, HBASE_PROTOCOL, decode_cached, prefetch, scan_salted_sample
+from mongo_pool import DATABASE_NAME, get_client
 import happybase
+import numba
+import numpy as np
 
 # --- Configuration ---
-MONGO_HOST = "localhost"
-MONGO_PORT = 27017
-MONGO_USER = "admin"
-MONGO_PASSWORD = "password123"
-MONGO_DB = "ecommerce"
-
 HBASE_HOST = "localhost"
 HBASE_PORT = 9090
 
@@ -17,9 +14,8 @@ HBASE_PORT = 9090
 # ============================================================
 def connect_mongodb():
     """Connect to MongoDB"""
-    connection_string = f"mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/"
-    client = MongoClient(connection_string)
-    db = client[MONGO_DB]
+    client = get_client()
+    db = client[DATABASE_NAME]
     print(" Connected to MongoDB")
     return client, db
 
@@ -27,7 +23,12 @@ def connect_mongodb():
 def connect_hbase():
     """Connect to HBase"""
     try:
-        connection = happybase.Connection(HBASE_HOST, HBASE_PORT)
+        connection = happybase.Connection(
+            HBASE_HOST,
+            HBASE_PORT,
+            transport=HBASE_TRANSPORT,
+            protocol=HBASE_PROTOCOL
+        )
         connection.open()
         print(" Connected to HBase")
         return connection
@@ -137,15 +138,115 @@ def customer_lifetime_value(mongo_db):
     return top_customers
 
 
+# ============================================================
+# HBASE SESSION SCAN (shared by funnel + dashboard)
+# ============================================================
+@numba.njit(cache=True)
+def count_by_code(codes, converted, n_codes):
+    """Per-category session and conversion counts over integer category codes"""
+    totals = np.zeros(n_codes, dtype=np.int64)
+    conversions = np.zeros(n_codes, dtype=np.int64)
+    for i in range(codes.shape[0]):
+        totals[codes[i]] += 1
+        if converted[i]:
+            conversions[codes[i]] += 1
+    return totals, conversions
+
+
+def conversion_by(codes, labels, converted):
+    """Map category codes back to {label: {'total', 'converted'}}"""
+    totals, conversions = count_by_code(codes, converted, len(labels))
+    return {
+        label: {'total': int(totals[code]), 'converted': int(conversions[code])}
+        for label, code in labels.items()
+    }
+
+
+def scan_aggregate(hbase_conn, limit=100000):
+    """
+    Scan the HBase sessions table once and compute every session metric
+    used by the funnel analysis and the integrated dashboard.
+    
+    Both analyses read overlapping columns, so a single pass avoids
+    shipping the same rows over Thrift twice.
+    """
+    
+    if not hbase_conn:
+        return None
+    
+    print("Fetching session data from HBase...")
+    
+    statuses = []
+    devices = []
+    referrers = []
+    page_views = []
+    durations = []
+    
+    table = hbase_conn.table('sessions')
+    
+    # Only the scalar columns used below; skips the activity JSON blobs
+    session_columns = [
+        b'session_info:conversion_status',
+        b'session_info:referrer',
+        b'session_info:duration',
+        b'device:type',
+        b'activity:page_views_count'
+    ]
+    
+    # Low-cardinality columns are stored as integer codes, assigned as
+    # new values show up; aggregation happens in count_by_code below
+    status_codes = {}
+    device_codes = {}
+    referrer_codes = {}
+    
+    # Sample every salt bucket evenly rather than only the first key range
+    scan = scan_salted_sample(table, limit, session_columns)
+    for key, data in prefetch(scan):
+        status = decode_cached(data.get(b'session_info:conversion_status', b''))
+        device = decode_cached(data.get(b'device:type', b''))
+        referrer = decode_cached(data.get(b'session_info:referrer', b''))
+        statuses.append(status_codes.setdefault(status, len(status_codes)))
+        devices.append(device_codes.setdefault(device, len(device_codes)))
+        referrers.append(referrer_codes.setdefault(referrer, len(referrer_codes)))
+        page_views.append(int(data.get(b'activity:page_views_count', b'0').decode() or 0))
+        durations.append(int(data.get(b'session_info:duration', b'0').decode() or 0))
+    
+    statuses = np.array(statuses, dtype=np.int32)
+    devices = np.array(devices, dtype=np.int32)
+    referrers = np.array(referrers, dtype=np.int32)
+    page_views = np.array(page_views, dtype=np.int64)
+    durations = np.array(durations, dtype=np.int64)
+    
+    converted = statuses == status_codes.get('converted', -1)
+    in_cart = converted | (statuses == status_codes.get('abandoned', -1))
+    
+    status_stats = conversion_by(statuses, status_codes, converted)
+    
+    stats = {
+        'total_sessions': len(statuses),
+        'sessions_with_views': int((page_views > 1).sum()),
+        'sessions_with_cart': int(in_cart.sum()),
+        'converted_sessions': int(converted.sum()),
+        'total_duration': int(durations.sum()),
+        'device_stats': conversion_by(devices, device_codes, converted),
+        'referrer_stats': conversion_by(referrers, referrer_codes, converted),
+        'status_stats': {status: counts['total'] for status, counts in status_stats.items()}
+    }
+    
+    print(f"   Analyzed {stats['total_sessions']:,} sessions")
+    return stats
+
+
 # ============================================================
 # ANALYSIS 2: FUNNEL CONVERSION ANALYSIS
 # ============================================================
-def funnel_conversion_analysis(hbase_conn):
+def funnel_conversion_analysis(session_stats):
     """
     Analyze the conversion funnel from browsing to purchase.
     
     Data Sources:
-    - HBase: Session data (browsing behavior, conversion status)
+    - HBase: Session data (browsing behavior, conversion status),
+      pre-aggregated by scan_aggregate()
     """
     
     print("\n" + "=" * 70)
@@ -154,60 +255,16 @@ def funnel_conversion_analysis(hbase_conn):
     print("\nData Sources: HBase (sessions)")
     print("Business Question: Where do we lose customers in the buying journey?\n")
     
-    if not hbase_conn:
+    if not session_stats:
         print(" HBase not available, skipping funnel analysis")
         return None
     
-    print("Fetching session data from HBase...")
-    
-    total_sessions = 0
-    sessions_with_views = 0
-    sessions_with_cart = 0
-    converted_sessions = 0
-    
-    device_stats = {}
-    referrer_stats = {}
-    status_stats = {}
-    
-    table = hbase_conn.table('sessions')
-    
-    for key, data in table.scan(limit=50000):
-        total_sessions += 1
-        
-        status = data.get(b'session_info:conversion_status', b'').decode()
-        device = data.get(b'device:type', b'').decode()
-        referrer = data.get(b'session_info:referrer', b'').decode()
-        page_views = int(data.get(b'activity:page_views_count', b'0').decode() or 0)
-        
-        if page_views > 1:
-            sessions_with_views += 1
-        
-        if status in ['abandoned', 'converted']:
-            sessions_with_cart += 1
-        
-        if status == 'converted':
-            converted_sessions += 1
-        
-        # Device stats
-        if device not in device_stats:
-            device_stats[device] = {'total': 0, 'converted': 0}
-        device_stats[device]['total'] += 1
-        if status == 'converted':
-            device_stats[device]['converted'] += 1
-        
-        # Referrer stats
-        if referrer not in referrer_stats:
-            referrer_stats[referrer] = {'total': 0, 'converted': 0}
-        referrer_stats[referrer]['total'] += 1
-        if status == 'converted':
-            referrer_stats[referrer]['converted'] += 1
-        
-        # Status stats
-        if status not in status_stats:
-            status_stats[status] = 0
-        status_stats[status] += 1
-    
-    print(f"   Analyzed {total_sessions:,} sessions")
+    total_sessions = session_stats['total_sessions']
+    sessions_with_views = session_stats['sessions_with_views']
+    sessions_with_cart = session_stats['sessions_with_cart']
+    converted_sessions = session_stats['converted_sessions']
+    device_stats = session_stats['device_stats']
+    referrer_stats = session_stats['referrer_stats']
     
     # Display Funnel
     print(f"""
@@ -247,7 +304,7 @@ def funnel_conversion_analysis(hbase_conn):
 # ============================================================
 # ANALYSIS 3: INTEGRATED BUSINESS DASHBOARD
 # ============================================================
-def integrated_dashboard(mongo_db, hbase_conn):
+def integrated_dashboard(mongo_db, session_stats):
     """
     Create an integrated business dashboard combining all data sources.
     """
@@ -277,20 +334,15 @@ def integrated_dashboard(mongo_db, hbase_conn):
     total_products = mongo_db.products.count_documents({})
     active_products = mongo_db.products.count_documents({"is_active": True})
     
-    # HBase Metrics
-    print("Fetching HBase metrics...")
-    
+    # HBase Metrics (from the shared session scan)
     session_count = 0
     converted_count = 0
     total_duration = 0
     
-    if hbase_conn:
-        table = hbase_conn.table('sessions')
-        for key, data in table.scan(limit=100000):
-            session_count += 1
-            if data.get(b'session_info:conversion_status', b'').decode() == 'converted':
-                converted_count += 1
-            total_duration += int(data.get(b'session_info:duration', b'0').decode() or 0)
+    if session_stats:
+        session_count = session_stats['total_sessions']
+        converted_count = session_stats['converted_sessions']
+        total_duration = session_stats['total_duration']
     
     avg_duration = total_duration / session_count if session_count > 0 else 0
     conv_rate = (converted_count / session_count * 100) if session_count > 0 else 0
@@ -351,8 +403,9 @@ def main():
     
     # Run Analyses
     clv_results = customer_lifetime_value(mongo_db)
-    funnel_results = funnel_conversion_analysis(hbase_conn)
-    dashboard = integrated_dashboard(mongo_db, hbase_conn)
+    session_stats = scan_aggregate(hbase_conn)
+    funnel_results = funnel_conversion_analysis(session_stats)
+    dashboard = integrated_dashboard(mongo_db, session_stats)
     
     # Summary
     print("\n" + "=" * 70)
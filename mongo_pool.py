@@ -0,0 +1,47 @@
+# mongo_pool.py
+# Shared MongoDB client for the loader, query and analytics scripts
+
+from pymongo import MongoClient
+import functools
+
+# --- MongoDB Connection ---
+# Using your docker-compose credentials
+MONGO_HOST = "localhost"
+MONGO_PORT = 27017
+MONGO_USER = "admin"
+MONGO_PASSWORD = "password123"
+DATABASE_NAME = "ecommerce"
+
+MONGO_URI = f"mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/"
+MONGO_MAX_POOL_SIZE = 50
+
+# Wire compression is negotiated per connection; the server picks the
+# first of these it also supports. zstd needs the zstandard package and
+# snappy needs python-snappy; PyMongo warns and skips either if missing,
+# and always has zlib to fall back on
+MONGO_COMPRESSORS = "zstd,snappy,zlib"
+MONGO_ZLIB_LEVEL = 3
+
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """Return the process-wide MongoClient, creating it on first use"""
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        compressors=MONGO_COMPRESSORS,
+        zlibCompressionLevel=MONGO_ZLIB_LEVEL,
+        retryWrites=True
+    )
+
+@functools.lru_cache(maxsize=1)
+def get_async_client():
+    """Return the process-wide motor client, creating it on first use"""
+    # Imported here so the synchronous scripts don't need motor installed
+    from motor.motor_asyncio import AsyncIOMotorClient
+    return AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        compressors=MONGO_COMPRESSORS,
+        zlibCompressionLevel=MONGO_ZLIB_LEVEL,
+        retryWrites=True
+    )
@@ -1,20 +1,33 @@
-import json
-from pymongo import MongoClient
+import ijson
+import orjson
+from mongo_pool import DATABASE_NAME, get_client
+from pymongo import IndexModel, UpdateOne
+from pymongo.write_concern import WriteConcern
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import argparse
 import os
+import time
 
-# --- MongoDB Connection ---
-# Using your docker-compose credentials
-MONGO_HOST = "localhost"
-MONGO_PORT = 27017
-MONGO_USER = "admin"
-MONGO_PASSWORD = "password123"
-DATABASE_NAME = "ecommerce"
+# Files larger than this are parsed with ijson instead of orjson
+STREAM_THRESHOLD_BYTES = 200 * 1024 * 1024
+
+# MongoDB's maxWriteBatchSize; PyMongo splits each insert_many into
+# messages under the 48 MB OP_MSG limit on its own
+INSERT_BATCH_SIZE = 100_000
+
+# The collections are dropped and reloaded from scratch, so the bulk
+# inserts skip the per-batch server acknowledgement; main() compares the
+# final counts with what was sent instead
+BULK_WRITE_CONCERN = WriteConcern(w=0)
+
+# How long to wait for unacknowledged inserts to finish applying
+VERIFY_TIMEOUT_SECONDS = 60
 
 def connect_to_mongodb():
     """Connect to MongoDB with authentication"""
-    connection_string = f"mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/"
-    client = MongoClient(connection_string)
+    client = get_client()
     
     # Test connection
     try:
@@ -29,96 +42,237 @@ def connect_to_mongodb():
 
 def load_json_file(filepath):
     """Load a JSON file and return its contents"""
-    print(f"Loading {filepath}...")
-    with open(filepath, 'r') as f:
-        data = json.load(f)
-    print(f"   Loaded {len(data):,} records")
+    # Very large files are parsed incrementally so the raw bytes and the
+    # decoded records are never held in memory at the same time
+    if os.path.getsize(filepath) > STREAM_THRESHOLD_BYTES:
+        data = list(iter_json_file(filepath))
+    else:
+        tqdm.write(f"Loading {filepath}...")
+        with open(filepath, 'rb') as f:
+            data = orjson.loads(f.read())
+    tqdm.write(f"   Loaded {len(data):,} records")
     return data
 
-def load_categories(db, filepath):
-    """Load categories into MongoDB"""
-    print("\n--- Loading Categories ---")
-    data = load_json_file(filepath)
+def iter_json_file(filepath):
+    """Stream the records of a top-level JSON array one at a time"""
+    tqdm.write(f"Streaming {filepath}...")
+    with open(filepath, 'rb') as f:
+        # use_float keeps numbers as float; BSON cannot encode Decimal
+        yield from ijson.items(f, 'item', use_float=True)
+
+def bulk_collection(db, name):
+    """Return a handle on a collection that writes without acknowledgement"""
+    return db.get_collection(name, write_concern=BULK_WRITE_CONCERN)
+
+def progress_bar(collection, records):
+    """
+    Progress bar for writing records into a collection (total unknown when streamed).
     
-    # Drop existing collection
-    db.categories.drop()
+    The loaders run side by side with a bar each, so anything they print
+    goes through tqdm.write, which redraws the bars below the message
+    instead of overwriting them.
+    """
+    total = len(records) if hasattr(records, '__len__') else None
+    return tqdm(total=total, desc=f"   {collection.name}", unit='docs', unit_scale=True)
+
+def insert_in_batches(collection, records, batch_size=INSERT_BATCH_SIZE):
+    """
+    Insert an iterable of documents with one unordered insert_many per batch.
     
-    # Insert data
-    result = db.categories.insert_many(data)
-    print(f" Inserted {len(result.inserted_ids):,} categories")
+    Returns the number of documents sent; with an unacknowledged write
+    concern the server reports nothing back, see verify_loaded.
+    """
+    total_sent = 0
+    batch = []
     
-    # Create index
-    db.categories.create_index("category_id", unique=True)
-    print("   Created index on category_id")
-
-def load_products(db, filepath):
-    """Load products into MongoDB"""
-    print("\n--- Loading Products ---")
-    data = load_json_file(filepath)
+    with progress_bar(collection, records) as pbar:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                collection.insert_many(batch, ordered=False)
+                total_sent += len(batch)
+                pbar.update(len(batch))
+                batch = []
+        
+        if batch:
+            collection.insert_many(batch, ordered=False)
+            total_sent += len(batch)
+            pbar.update(len(batch))
     
-    # Drop existing collection
-    db.products.drop()
+    return total_sent
+
+def verify_loaded(db, sent, timeout=VERIFY_TIMEOUT_SECONDS):
+    """
+    Check that each collection holds as many documents as were sent to it.
     
-    # Insert data
-    result = db.products.insert_many(data)
-    print(f" Inserted {len(result.inserted_ids):,} products")
+    w=0 inserts go out over several pooled connections and are neither
+    acknowledged nor ordered across them, so some may still be applying
+    when the loaders return; wait while the counts are still short.
+    Polling reads the count from collection metadata, and one exact count
+    confirms the result (only the _id index exists yet, so count_documents
+    is a full scan). Raises RuntimeError listing any collection that ends
+    up short.
+    """
+    mismatches = []
+    deadline = time.monotonic() + timeout
+    for name, expected in sent.items():
+        while db[name].estimated_document_count() < expected and time.monotonic() < deadline:
+            time.sleep(0.5)
+        count = db[name].count_documents({})
+        if count != expected:
+            mismatches.append(f"{name}: {count:,} stored, {expected:,} sent")
     
-    # Create indexes
-    db.products.create_index("product_id", unique=True)
-    db.products.create_index("category_id")
-    db.products.create_index("is_active")
-    db.products.create_index("base_price")
-    print("   Created indexes on product_id, category_id, is_active, base_price")
+    if mismatches:
+        raise RuntimeError("Unacknowledged inserts were lost: " + "; ".join(mismatches))
 
-def load_users(db, filepath):
-    """Load users into MongoDB"""
-    print("\n--- Loading Users ---")
-    data = load_json_file(filepath)
+def upsert_in_batches(collection, records, key, batch_size=INSERT_BATCH_SIZE):
+    """
+    Insert the documents whose natural key is not in the collection yet,
+    one unordered bulk_write of $setOnInsert upserts per batch.
+    """
+    total_upserted = 0
+    batch = []
     
-    # Drop existing collection
-    db.users.drop()
+    def write_batch(batch):
+        # Key order turns random unique-index insertions into near-sequential
+        # ones, so fewer B-tree pages split
+        batch.sort(key=lambda record: record[key])
+        requests = [UpdateOne({key: record[key]}, {"$setOnInsert": record}, upsert=True) for record in batch]
+        return collection.bulk_write(requests, ordered=False).upserted_count
     
-    # Insert data
-    result = db.users.insert_many(data)
-    print(f" Inserted {len(result.inserted_ids):,} users")
+    with progress_bar(collection, records) as pbar:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                total_upserted += write_batch(batch)
+                pbar.update(len(batch))
+                batch = []
+        
+        if batch:
+            total_upserted += write_batch(batch)
+            pbar.update(len(batch))
     
-    # Create indexes
-    db.users.create_index("user_id", unique=True)
-    db.users.create_index("geo_data.state")
-    db.users.create_index("registration_date")
-    print("   Created indexes on user_id, geo_data.state, registration_date")
+    return total_upserted
 
-def load_transactions(db, filepath):
-    """Load transactions into MongoDB"""
-    print("\n--- Loading Transactions ---")
-    data = load_json_file(filepath)
+def store_records(db, name, records, key, incremental=False):
+    """
+    Reload a collection from scratch, or only add new records if incremental.
+    
+    Returns the number of documents upserted, or sent for a full reload.
+    """
+    if incremental:
+        # Reruns touch only documents missing from the collection
+        total_upserted = upsert_in_batches(db[name], records, key)
+        tqdm.write(f" Upserted {total_upserted:,} new {name}")
+        return total_upserted
     
     # Drop existing collection
-    db.transactions.drop()
+    db[name].drop()
     
-    # Insert in batches for large datasets
-    batch_size = 10000
-    total_inserted = 0
+    # Insert data; the count is checked against the server in main()
+    total_sent = insert_in_batches(bulk_collection(db, name), records)
+    tqdm.write(f" Sent {total_sent:,} {name}")
+    return total_sent
+
+def load_categories_data(db, filepath, incremental=False):
+    """Load categories into MongoDB"""
+    tqdm.write("\n--- Loading Categories ---")
+    data = load_json_file(filepath)
+    return store_records(db, "categories", data, "category_id", incremental)
+
+def create_categories_indexes(db):
+    """Create indexes on the loaded categories"""
+    db.categories.create_index("category_id", unique=True)
+    print("   Created index on category_id")
+
+def load_products_data(db, filepath, incremental=False):
+    """Load products into MongoDB"""
+    tqdm.write("\n--- Loading Products ---")
+    data = load_json_file(filepath)
+    return store_records(db, "products", data, "product_id", incremental)
+
+def create_products_indexes(db):
+    """Create indexes on the loaded products"""
+    # One createIndexes command builds them all in a single collection scan
+    db.products.create_indexes([
+        IndexModel("product_id", unique=True),
+        IndexModel("category_id"),
+        IndexModel("is_active"),
+        IndexModel("base_price"),
+        # Covers the product name lookup in top_selling_products
+        IndexModel([("product_id", 1), ("name", 1), ("category_id", 1)])
+    ])
+    print("   Created indexes on product_id, category_id, is_active, base_price, (product_id, name, category_id)")
+
+def load_users_data(db, filepath, incremental=False):
+    """Load users into MongoDB"""
+    tqdm.write("\n--- Loading Users ---")
+    data = load_json_file(filepath)
+    return store_records(db, "users", data, "user_id", incremental)
+
+def create_users_indexes(db):
+    """Create indexes on the loaded users"""
+    # One createIndexes command builds them all in a single collection scan
+    db.users.create_indexes([
+        IndexModel("user_id", unique=True),
+        IndexModel("geo_data.state"),
+        IndexModel("registration_date")
+    ])
+    print("   Created indexes on user_id, geo_data.state, registration_date")
+
+def denormalize_transactions(transactions, product_categories):
+    """
+    Copy each item's product category onto the item, and add the YYYY-MM month.
     
-    for i in range(0, len(data), batch_size):
-        batch = data[i:i+batch_size]
-        result = db.transactions.insert_many(batch)
-        total_inserted += len(result.inserted_ids)
-        print(f"   Inserted batch {i//batch_size + 1}: {total_inserted:,} total")
+    mongodb_queries.py and visualizations.py group on these stored fields.
+    Transactions loaded by a version of this script without them must be
+    reloaded with --full; --incremental only adds missing documents and
+    leaves existing ones untouched.
+    """
+    for transaction in transactions:
+        for item in transaction.get('items', ()):
+            item['category_id'] = product_categories.get(item['product_id'])
+        # timestamp is an ISO 8601 string, so its first 7 characters are the month
+        transaction['month'] = transaction['timestamp'][:7]
+        yield transaction
+
+def load_transactions_data(db, filepath, products_filepath, incremental=False):
+    """Load transactions into MongoDB"""
+    tqdm.write("\n--- Loading Transactions ---")
     
-    print(f" Inserted {total_inserted:,} transactions")
+    # Denormalize category_id onto items so category rollups need no joins,
+    # and the month so monthly rollups group on a stored field
+    product_categories = {p['product_id']: p['category_id'] for p in load_json_file(products_filepath)}
     
-    # Create indexes
-    db.transactions.create_index("transaction_id", unique=True)
-    db.transactions.create_index("user_id")
-    db.transactions.create_index("session_id")
-    db.transactions.create_index("timestamp")
-    db.transactions.create_index("status")
-    db.transactions.create_index("items.product_id")
-    print("   Created indexes on transaction_id, user_id, session_id, timestamp, status, items.product_id")
+    # Stream the file and write in batches, so only one batch is in memory
+    transactions = denormalize_transactions(iter_json_file(filepath), product_categories)
+    return store_records(db, "transactions", transactions, "transaction_id", incremental)
+
+def create_transactions_indexes(db):
+    """Create indexes on the loaded transactions"""
+    # One createIndexes command builds them all in a single collection scan
+    db.transactions.create_indexes([
+        IndexModel("transaction_id", unique=True),
+        IndexModel("user_id"),
+        IndexModel("session_id"),
+        IndexModel("timestamp"),
+        IndexModel("status"),
+        IndexModel("items.product_id"),
+        # Covers the per-user purchase stats aggregation
+        IndexModel([("user_id", 1), ("total", 1)], name="user_total_cov")
+    ])
+    print("   Created indexes on transaction_id, user_id, session_id, timestamp, status, items.product_id, (user_id, total)")
 
 def main():
     """Main function to load all data"""
+    parser = argparse.ArgumentParser(description="Load the e-commerce JSON data into MongoDB")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--full', dest='incremental', action='store_false',
+                      help="drop and reload every collection (default)")
+    mode.add_argument('--incremental', dest='incremental', action='store_true',
+                      help="upsert on each collection's natural id, adding only new documents")
+    args = parser.parse_args()
+    
     print("=" * 50)
     print("MongoDB Data Loader for E-commerce Project")
     print("=" * 50)
@@ -148,11 +302,52 @@ def main():
             print(f"    {name}: {filepath} NOT FOUND")
             return
     
-    # Load data into MongoDB
-    load_categories(db, files["categories"])
-    load_products(db, files["products"])
-    load_users(db, files["users"])
-    load_transactions(db, files["transactions"])
+    index_builders = [
+        create_categories_indexes,
+        create_products_indexes,
+        create_users_indexes,
+        create_transactions_indexes
+    ]
+    
+    # Upserts look up every natural id, so the unique indexes must exist
+    # first; createIndexes is a no-op for indexes already built
+    if args.incremental:
+        print("\n--- Creating Indexes ---")
+        for create_indexes in index_builders:
+            create_indexes(db)
+    
+    # Load data into MongoDB; the collections are disjoint, so the loaders
+    # share the client's connection pool and run side by side
+    loaders = {
+        "categories": (load_categories_data, files["categories"]),
+        "products": (load_products_data, files["products"]),
+        "users": (load_users_data, files["users"]),
+        "transactions": (load_transactions_data, files["transactions"], files["products"])
+    }
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = {
+            name: executor.submit(loader, db, *paths, incremental=args.incremental)
+            for name, (loader, *paths) in loaders.items()
+        }
+        sent = {name: future.result() for name, future in futures.items()}
+    
+    # Full reloads write without acknowledgement, so confirm nothing was
+    # dropped before reporting success
+    if not args.incremental:
+        print("\nVerifying document counts...")
+        verify_loaded(db, sent)
+        print(" Every document sent is stored")
+    
+    # Build indexes only once every collection is full, so each index is
+    # one bulk build instead of being maintained through every insert
+    if not args.incremental:
+        print("\n--- Creating Indexes ---")
+        for create_indexes in index_builders:
+            create_indexes(db)
+    
+    # mongodb_queries.py rebuilds user_purchase_stats from transactions; drop
+    # its refresh record so the next query rebuilds it from the new data
+    db.materialized_views.delete_one({"_id": "user_purchase_stats"})
     
     # Print summary
     print("\n" + "=" * 50)
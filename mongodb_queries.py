@@ -1,50 +1,88 @@
 # mongodb_queries.py
 # MongoDB Aggregation Pipelines for E-commerce Analytics
 
-from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from mongo_pool import DATABASE_NAME, get_async_client
+from pymongo.errors import OperationFailure
+from datetime import datetime, timedelta, timezone
+import argparse
+import asyncio
 import json
 
-# --- MongoDB Connection ---
-MONGO_HOST = "localhost"
-MONGO_PORT = 27017
-MONGO_USER = "admin"
-MONGO_PASSWORD = "password123"
-DATABASE_NAME = "ecommerce"
+# Server error codes for a blocking stage that ran out of its 100 MB
+# memory allowance with allowDiskUse off
+MEMORY_LIMIT_ERROR_CODES = {292, 16819, 16945}
+
+# user_purchase_stats is rebuilt when older than this, when mongodb_loader.py
+# has cleared its refresh record, or by cron with
+# `python mongodb_queries.py --refresh-stats`
+STATS_MAX_AGE = timedelta(hours=1)
+
+# Print-only result rows stay as raw BSON; a row is decoded only when a
+# field is first read from it
+RAW_BSON_OPTIONS = CodecOptions(document_class=RawBSONDocument)
 
 def connect_to_mongodb():
     """Connect to MongoDB with authentication"""
-    connection_string = f"mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/"
-    client = MongoClient(connection_string)
+    client = get_async_client()
     db = client[DATABASE_NAME]
     print(" Connected to MongoDB\n")
     return client, db
 
+async def aggregate_in_memory(collection, pipeline, batch_size=500, **options):
+    """Run a pipeline without spilling to disk, falling back if it must"""
+    # Motor sends the aggregate command on the first fetch, so a memory
+    # limit failure surfaces here, before any document has been yielded
+    yielded = False
+    try:
+        async for doc in collection.aggregate(pipeline, allowDiskUse=False, batchSize=batch_size, **options):
+            yielded = True
+            yield doc
+        return
+    except OperationFailure as e:
+        if yielded or e.code not in MEMORY_LIMIT_ERROR_CODES:
+            raise
+    print(f" Pipeline stage exceeded 100 MB on {collection.name}; rerunning with allowDiskUse=True")
+    print("   Consider adding a $project upstream to shrink the documents")
+    async for doc in collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size, **options):
+        yield doc
+
+async def collect(rows):
+    """Drain an async result stream into a list"""
+    return [doc async for doc in rows]
+
 
 # ============================================================
 # AGGREGATION 1: Top-Selling Products
 # ============================================================
-def top_selling_products(db, limit=10):
+def run_top_selling_products(db, limit=10):
     """
-    Find the top-selling products by total quantity sold.
+    Find the top-selling products by total quantity sold; returns the
+    result stream.
     
     Pipeline steps:
-    1. $unwind - Flatten the items array (each item becomes a document)
-    2. $group - Group by product_id, sum quantities and revenue
-    3. $sort - Sort by quantity descending
-    4. $limit - Get top N products
-    5. $lookup - Join with products collection to get product names
+    1. $project - Keep only the item fields the group needs
+    2. $unwind - Flatten the items array (each item becomes a document)
+    3. $group - Group by product_id, sum quantities and revenue
+    4. $sort - Sort by quantity descending
+    5. $limit - Get top N products
+    6. $lookup - Join with products collection to get product names
     """
     
-    print("=" * 60)
-    print("AGGREGATION 1: Top-Selling Products")
-    print("=" * 60)
-    print("Business Question: What are our best-selling products?\n")
-    
     pipeline = [
-        # Step 1: Unwind the items array
+        # Step 1: Drop every transaction field the later stages never read
+        {"$project": {
+            "_id": 0,
+            "items.product_id": 1,
+            "items.quantity": 1,
+            "items.subtotal": 1
+        }},
+        
+        # Step 2: Unwind the items array
         {"$unwind": "$items"},
         
-        # Step 2: Group by product_id and calculate totals
+        # Step 3: Group by product_id and calculate totals
         {"$group": {
             "_id": "$items.product_id",
             "total_quantity_sold": {"$sum": "$items.quantity"},
@@ -52,24 +90,28 @@ def top_selling_products(db, limit=10):
             "number_of_orders": {"$sum": 1}
         }},
         
-        # Step 3: Sort by quantity sold (descending)
+        # Step 4: Sort by quantity sold (descending)
         {"$sort": {"total_quantity_sold": -1}},
         
-        # Step 4: Limit to top N
+        # Step 5: Limit to top N
         {"$limit": limit},
         
-        # Step 5: Join with products collection to get product details
+        # Step 6: Join with products collection to get product details,
+        # fetching only the two fields used (covered by an index)
         {"$lookup": {
             "from": "products",
-            "localField": "_id",
-            "foreignField": "product_id",
+            "let": {"pid": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$product_id", "$$pid"]}}},
+                {"$project": {"_id": 0, "name": 1, "category_id": 1}}
+            ],
             "as": "product_info"
         }},
         
-        # Step 6: Unwind product_info (converts array to object)
+        # Step 7: Unwind product_info (converts array to object)
         {"$unwind": "$product_info"},
         
-        # Step 7: Project final fields
+        # Step 8: Project final fields
         {"$project": {
             "_id": 0,
             "product_id": "$_id",
@@ -81,7 +123,15 @@ def top_selling_products(db, limit=10):
         }}
     ]
     
-    results = list(db.transactions.aggregate(pipeline))
+    raw_transactions = db.transactions.with_options(codec_options=RAW_BSON_OPTIONS)
+    return aggregate_in_memory(raw_transactions, pipeline)
+
+def print_top_selling_products(results, limit=10):
+    """Print the top-selling products report"""
+    print("=" * 60)
+    print("AGGREGATION 1: Top-Selling Products")
+    print("=" * 60)
+    print("Business Question: What are our best-selling products?\n")
     
     print(f"Top {limit} Selling Products:")
     print("-" * 60)
@@ -93,110 +143,170 @@ def top_selling_products(db, limit=10):
         print(f"{i:<5} {name:<30} {product['total_quantity_sold']:<10} ${product['total_revenue']:,.2f}")
     
     print()
-    return results
 
 
 # ============================================================
 # AGGREGATION 2: Revenue by Category
 # Business Question: Which product categories generate the most revenue?
 # ============================================================
-def revenue_by_category(db):
+def run_revenue_by_category(db):
     """
-    Calculate total revenue for each product category.
+    Calculate total revenue for each product category; returns the result
+    stream.
     
     Pipeline steps:
     1. $unwind - Flatten items array
-    2. $lookup - Join with products to get category_id
-    3. $unwind - Flatten the lookup result
-    4. $lookup - Join with categories to get category name
-    5. $unwind - Flatten categories
-    6. $group - Group by category and sum revenue
-    7. $sort - Sort by revenue descending
+    2. $group - Group by the category_id denormalized onto each item
+    3. $lookup - Join the grouped rows with categories to get category name
+    4. $unwind - Flatten categories
+    5. $sort - Sort by revenue descending
     """
     
-    print("=" * 60)
-    print("AGGREGATION 2: Revenue by Category")
-    print("=" * 60)
-    print("Business Question: Which categories generate the most revenue?\n")
-    
     pipeline = [
         # Step 1: Unwind items array
         {"$unwind": "$items"},
         
-        # Step 2: Lookup product details
-        {"$lookup": {
-            "from": "products",
-            "localField": "items.product_id",
-            "foreignField": "product_id",
-            "as": "product"
+        # Step 2: Group by category (set on each item by the loader)
+        {"$group": {
+            "_id": "$items.category_id",
+            "total_revenue": {"$sum": "$items.subtotal"},
+            "total_items_sold": {"$sum": "$items.quantity"},
+            "number_of_transactions": {"$sum": 1}
         }},
         
-        # Step 3: Unwind product
-        {"$unwind": "$product"},
-        
-        # Step 4: Lookup category details
+        # Step 3: Lookup category details, once per category
         {"$lookup": {
             "from": "categories",
-            "localField": "product.category_id",
+            "localField": "_id",
             "foreignField": "category_id",
             "as": "category"
         }},
         
-        # Step 5: Unwind category
+        # Step 4: Unwind category
         {"$unwind": "$category"},
         
-        # Step 6: Group by category
-        {"$group": {
-            "_id": {
-                "category_id": "$category.category_id",
-                "category_name": "$category.name"
-            },
-            "total_revenue": {"$sum": "$items.subtotal"},
-            "total_items_sold": {"$sum": "$items.quantity"},
-            "number_of_transactions": {"$sum": 1}
-        }},
-        
-        # Step 7: Sort by revenue descending
+        # Step 5: Sort by revenue descending
         {"$sort": {"total_revenue": -1}},
         
-        # Step 8: Project final fields
+        # Step 6: Project final fields
         {"$project": {
             "_id": 0,
-            "category_id": "$_id.category_id",
-            "category_name": "$_id.category_name",
+            "category_id": "$_id",
+            "category_name": "$category.name",
             "total_revenue": {"$round": ["$total_revenue", 2]},
             "total_items_sold": 1,
             "number_of_transactions": 1
         }}
     ]
     
-    results = list(db.transactions.aggregate(pipeline))
+    return aggregate_in_memory(db.transactions, pipeline)
+
+def print_revenue_by_category(results):
+    """Print the revenue by category report"""
+    print("=" * 60)
+    print("AGGREGATION 2: Revenue by Category")
+    print("=" * 60)
+    print("Business Question: Which categories generate the most revenue?\n")
+    
+    if not results:
+        # Only happens if items lack the category_id the loader stores
+        print(" No category revenue found. Transactions loaded by an older")
+        print(" mongodb_loader.py have no items.category_id; reload them with")
+        print("   python mongodb_loader.py --full\n")
+        return
     
     print(f"Revenue by Category (All {len(results)} categories):")
     print("-" * 70)
     print(f"{'Rank':<5} {'Category':<25} {'Revenue':<15} {'Items Sold':<12} {'Orders':<10}")
     print("-" * 70)
     
+    # Sum the total in the same pass as printing
+    total_revenue = 0
     for i, cat in enumerate(results, 1):
+        total_revenue += cat['total_revenue']
         name = cat['category_name'][:23] if len(cat['category_name']) > 23 else cat['category_name']
         print(f"{i:<5} {name:<25} ${cat['total_revenue']:>12,.2f} {cat['total_items_sold']:<12} {cat['number_of_transactions']:<10}")
     
-    # Calculate total
-    total_revenue = sum(cat['total_revenue'] for cat in results)
     print("-" * 70)
     print(f"{'TOTAL':<31} ${total_revenue:>12,.2f}")
     print()
+
+
+# ============================================================
+# MATERIALIZED VIEW: Per-User Purchase Stats
+# ============================================================
+async def refresh_user_purchase_stats(db):
+    """
+    Rebuild user_purchase_stats {_id: user_id, purchase_count, total_spent,
+    segment} from transactions with $out, and record when it was refreshed.
+    
+    $out swaps the new collection in atomically, so users no longer in
+    transactions disappear with the rebuild; indexes already on the
+    collection are kept.
+    
+    segment is the lower bound of the user's frequency band (1, 2, 6, 16),
+    or "Other" at 1000+ purchases.
+    """
+    refreshed_at = datetime.now(timezone.utc)
+    
+    pipeline = [
+        {"$project": {"_id": 0, "user_id": 1, "total": 1}},
+        {"$group": {
+            "_id": "$user_id",
+            "purchase_count": {"$sum": 1},
+            "total_spent": {"$sum": "$total"}
+        }},
+        {"$set": {
+            "segment": {
+                "$switch": {
+                    "branches": [
+                        {"case": {"$lt": ["$purchase_count", 2]}, "then": 1},
+                        {"case": {"$lt": ["$purchase_count", 6]}, "then": 2},
+                        {"case": {"$lt": ["$purchase_count", 16]}, "then": 6},
+                        {"case": {"$lt": ["$purchase_count", 1000]}, "then": 16}
+                    ],
+                    "default": "Other"
+                }
+            }
+        }},
+        {"$out": "user_purchase_stats"}
+    ]
+    # The (user_id, total) index covers the $project, so the scan reads
+    # index keys only and never fetches a transaction document. The hint
+    # fails if the index is missing (a database indexed by an older loader),
+    # so make sure it exists; createIndexes is a no-op once it's built.
+    # $out returns no documents, so exhaust the cursor to finish the write
+    await db.transactions.create_index([("user_id", 1), ("total", 1)], name="user_total_cov")
+    async for _ in aggregate_in_memory(db.transactions, pipeline, hint="user_total_cov"):
+        pass
+    await db.user_purchase_stats.create_index("segment")
     
-    return results
+    await db.materialized_views.replace_one(
+        {"_id": "user_purchase_stats"},
+        {"_id": "user_purchase_stats", "last_refreshed_at": refreshed_at},
+        upsert=True
+    )
+    print(f" Refreshed user_purchase_stats at {refreshed_at:%Y-%m-%d %H:%M:%S} UTC")
+    return refreshed_at
+
+async def ensure_user_purchase_stats(db, max_age=STATS_MAX_AGE):
+    """Return when user_purchase_stats was last refreshed, rebuilding it if stale"""
+    meta = await db.materialized_views.find_one({"_id": "user_purchase_stats"})
+    if meta is not None:
+        last_refreshed_at = meta["last_refreshed_at"].replace(tzinfo=timezone.utc)
+        if datetime.now(timezone.utc) - last_refreshed_at < max_age:
+            return last_refreshed_at
+    return await refresh_user_purchase_stats(db)
 
 
 # ============================================================
 # AGGREGATION 3: User Segmentation by Purchasing Frequency
 # Business Question: How do we categorize customers by their buying behavior?
 # ============================================================
-def user_segmentation_by_frequency(db):
+async def run_user_segmentation_by_frequency(db):
     """
-    Segment users by how frequently they purchase.
+    Segment users by how frequently they purchase; returns when the stats
+    were last refreshed, and the result stream.
     
     Segments:
     - One-time buyers: 1 purchase
@@ -204,38 +314,29 @@ def user_segmentation_by_frequency(db):
     - Regular buyers: 6-15 purchases
     - Loyal customers: 16+ purchases
     
+    Runs over the materialized user_purchase_stats collection, which holds
+    one pre-aggregated document per user with its segment already set.
+    
     Pipeline steps:
-    1. $group - Group by user_id, count transactions, sum spending
-    2. $bucket - Categorize into frequency segments
+    1. $group - Group users by their precomputed segment
+    2. $sort - Order segments by frequency band
     3. $project - Format output
     """
     
-    print("=" * 60)
-    print("AGGREGATION 3: User Segmentation by Purchasing Frequency")
-    print("=" * 60)
-    print("Business Question: How do we categorize customers by buying behavior?\n")
+    last_refreshed_at = await ensure_user_purchase_stats(db)
     
     pipeline = [
-        # Step 1: Group by user to get purchase stats
+        # Step 1: Group by segment (1, 2-5, 6-15, 16+)
         {"$group": {
-            "_id": "$user_id",
-            "purchase_count": {"$sum": 1},
-            "total_spent": {"$sum": "$total"},
-            "avg_order_value": {"$avg": "$total"}
+            "_id": "$segment",
+            "customer_count": {"$sum": 1},
+            "total_revenue": {"$sum": "$total_spent"},
+            "avg_purchases_per_customer": {"$avg": "$purchase_count"},
+            "avg_customer_value": {"$avg": "$total_spent"}
         }},
         
-        # Step 2: Bucket into segments
-        {"$bucket": {
-            "groupBy": "$purchase_count",
-            "boundaries": [1, 2, 6, 16, 1000],  # 1, 2-5, 6-15, 16+
-            "default": "Other",
-            "output": {
-                "customer_count": {"$sum": 1},
-                "total_revenue": {"$sum": "$total_spent"},
-                "avg_purchases_per_customer": {"$avg": "$purchase_count"},
-                "avg_customer_value": {"$avg": "$total_spent"}
-            }
-        }},
+        # Step 2: Sort by band lower bound ("Other" sorts last)
+        {"$sort": {"_id": 1}},
         
         # Step 3: Add segment labels
         {"$project": {
@@ -258,9 +359,16 @@ def user_segmentation_by_frequency(db):
         }}
     ]
     
-    results = list(db.transactions.aggregate(pipeline))
+    return last_refreshed_at, aggregate_in_memory(db.user_purchase_stats, pipeline)
+
+def print_user_segmentation_by_frequency(results, last_refreshed_at):
+    """Print the user segmentation report"""
+    print("=" * 60)
+    print("AGGREGATION 3: User Segmentation by Purchasing Frequency")
+    print("=" * 60)
+    print("Business Question: How do we categorize customers by buying behavior?\n")
     
-    print("Customer Segments by Purchase Frequency:")
+    print(f"Customer Segments by Purchase Frequency (as of {last_refreshed_at:%Y-%m-%d %H:%M:%S} UTC):")
     print("-" * 75)
     print(f"{'Segment':<22} {'Customers':<12} {'Revenue':<15} {'Avg Purchases':<15} {'Avg Value':<12}")
     print("-" * 75)
@@ -276,15 +384,18 @@ def user_segmentation_by_frequency(db):
     print("-" * 75)
     print(f"{'TOTAL':<22} {total_customers:<12} ${total_revenue:>12,.2f}")
     print()
-    
-    return results
 
 
 # ============================================================
 # MAIN FUNCTION
 # ============================================================
-def main():
-    """Run all aggregation queries"""
+async def run_queries(refresh_stats=False):
+    """Run all aggregation queries concurrently on one client"""
+    if refresh_stats:
+        client, db = connect_to_mongodb()
+        await refresh_user_purchase_stats(db)
+        client.close()
+        return
     
     print("\n" + "=" * 60)
     print("   MONGODB AGGREGATION QUERIES - E-COMMERCE ANALYTICS")
@@ -293,10 +404,21 @@ def main():
     # Connect
     client, db = connect_to_mongodb()
     
-    # Run aggregations
-    top_products = top_selling_products(db, limit=10)
-    category_revenue = revenue_by_category(db)
-    user_segments = user_segmentation_by_frequency(db)
+    async def collect_user_segments():
+        last_refreshed_at, rows = await run_user_segmentation_by_frequency(db)
+        return last_refreshed_at, await collect(rows)
+    
+    # Run aggregations; they are independent reads, so overlap them, then
+    # print in order once all results are in so the reports don't interleave
+    top_products, category_revenue, (segments_refreshed_at, user_segments) = await asyncio.gather(
+        collect(run_top_selling_products(db, limit=10)),
+        collect(run_revenue_by_category(db)),
+        collect_user_segments()
+    )
+    
+    print_top_selling_products(top_products, limit=10)
+    print_revenue_by_category(category_revenue)
+    print_user_segmentation_by_frequency(user_segments, segments_refreshed_at)
     
     
     # Summary
@@ -312,6 +434,15 @@ def main():
     client.close()
     print("\n All queries completed successfully!")
 
+def main():
+    """Run all aggregation queries"""
+    parser = argparse.ArgumentParser(description="Run the MongoDB analytics aggregations")
+    parser.add_argument('--refresh-stats', action='store_true',
+                        help="only rebuild user_purchase_stats (for a scheduled job)")
+    args = parser.parse_args()
+    
+    asyncio.run(run_queries(refresh_stats=args.refresh_stats))
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
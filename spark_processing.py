@@ -3,9 +3,11 @@ from pyspark.sql.functions import (
     col, explode, count, sum as spark_sum, avg, 
     desc, asc, round as spark_round, collect_list,
     size, array_intersect, when, lit, to_date,
-    month, year, dayofweek, hour, concat, first
+    month, year, dayofweek, hour, concat, first,
+    array_sort, expr
 )
 from pyspark.sql.types import *
+from pyspark import StorageLevel
 import os
 
 # --- Initialize Spark ---
@@ -16,6 +18,9 @@ def create_spark_session():
         .config("spark.driver.memory", "8g") \
         .config("spark.executor.memory", "4g") \
         .config("spark.sql.shuffle.partitions", "4") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m") \
         .config("spark.driver.maxResultSize", "2g") \
         .getOrCreate()
     
@@ -322,18 +327,27 @@ def product_recommendations(spark, transactions_df):
         .groupBy("transaction_id") \
         .agg(collect_list("product_id").alias("products"))
     
-    # Filter transactions with multiple products
-    multi_product_txns = products_per_txn.filter(size(col("products")) > 1)
+    # Filter transactions with multiple products; cached because the count
+    # below and the pair generation would otherwise both rerun the explode
+    # and groupBy (already hash-partitioned by transaction_id)
+    multi_product_txns = products_per_txn \
+        .filter(size(col("products")) > 1) \
+        .persist(StorageLevel.MEMORY_AND_DISK)
     print(f"Transactions with multiple products: {multi_product_txns.count():,}\n")
     
-    # Self-join to find product pairs
-    from pyspark.sql.functions import arrays_zip
-    
-    # Explode to get all pairs
+    # Build every (a, b) pair of a transaction in one array of structs:
+    # with the array sorted, pairing each product only with the ones after
+    # it yields just the upper triangle (no diagonal, no reversed pairs),
+    # so a single explode emits C(k, 2) rows and no k^2 intermediate
+    upper_pairs = expr("""
+        flatten(transform(products, (a, i) ->
+            transform(slice(products, i + 2, size(products)), b -> named_struct('a', a, 'b', b))))
+    """)
     product_pairs = multi_product_txns \
-        .withColumn("product_a", explode(col("products"))) \
-        .withColumn("product_b", explode(col("products"))) \
-        .filter(col("product_a") < col("product_b"))  # Avoid duplicates
+        .withColumn("products", array_sort(col("products"))) \
+        .withColumn("pair", explode(upper_pairs)) \
+        .select(col("pair.a").alias("product_a"), col("pair.b").alias("product_b")) \
+        .filter(col("product_a") < col("product_b"))  # Drop a product paired with itself
     
     # Count co-occurrences
     pair_counts = product_pairs \
@@ -366,6 +380,8 @@ def product_recommendations(spark, transactions_df):
     """)
     recommendations.show(truncate=False)
     
+    multi_product_txns.unpersist()
+    
     return pair_counts
 
 
@@ -392,16 +408,28 @@ def cohort_analysis(spark, users_df, transactions_df):
     users_cohort.createOrReplaceTempView("users_cohort")
     transactions_df.createOrReplaceTempView("transactions")
     
+    # Roll transactions up to one row per user before joining, so the large
+    # side is partially aggregated ahead of the shuffle and the per-user
+    # totals are small enough to broadcast (the average is rebuilt from sums)
     cohort_spending = spark.sql("""
-        SELECT 
+        WITH user_totals AS (
+            SELECT 
+                user_id,
+                COUNT(transaction_id) as transaction_count,
+                SUM(total) as revenue,
+                COUNT(total) as priced_transactions
+            FROM transactions
+            GROUP BY user_id
+        )
+        SELECT /*+ BROADCAST(t) */
             u.cohort_month,
             COUNT(DISTINCT u.user_id) as users_in_cohort,
             COUNT(DISTINCT t.user_id) as users_who_purchased,
-            COUNT(t.transaction_id) as total_transactions,
-            ROUND(SUM(t.total), 2) as total_revenue,
-            ROUND(AVG(t.total), 2) as avg_order_value
+            COALESCE(SUM(t.transaction_count), 0) as total_transactions,
+            ROUND(SUM(t.revenue), 2) as total_revenue,
+            ROUND(SUM(t.revenue) / NULLIF(SUM(t.priced_transactions), 0), 2) as avg_order_value
         FROM users_cohort u
-        LEFT JOIN transactions t ON u.user_id = t.user_id
+        LEFT JOIN user_totals t ON u.user_id = t.user_id
         GROUP BY u.cohort_month
         ORDER BY u.cohort_month
     """)
@@ -1,17 +1,19 @@
+import matplotlib
+matplotlib.use("Agg")  # files only, no GUI; set before pyplot is imported
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import numpy as np
-from pymongo import MongoClient
+from hbase_common import HBASE_TRANSPORT, HBASE_PROTOCOL, scan_salted_sample
+from mongo_pool import DATABASE_NAME, get_client
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 import happybase
+import itertools
+import json
 import os
 
 # --- Configuration ---
-MONGO_HOST = "localhost"
-MONGO_PORT = 27017
-MONGO_USER = "admin"
-MONGO_PASSWORD = "password123"
-MONGO_DB = "ecommerce"
-
 HBASE_HOST = "localhost"
 HBASE_PORT = 9090
 
@@ -19,6 +21,27 @@ HBASE_PORT = 9090
 OUTPUT_DIR = r"D:\Patrick\AUCA\SEM3\bigdatanalytics\ecommerce_project\visualizations"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Charts 1, 2, 4 and 5 are redrawn only when the MongoDB data they read changes
+MONGO_CHARTS = [
+    '1_revenue_by_category',
+    '2_customer_segments',
+    '4_monthly_revenue_trend',
+    '5_top_products'
+]
+CHART_CACHE_FILE = os.path.join(OUTPUT_DIR, 'chart_cache.json')
+
+# Bar and pie charts gain nothing above 100 DPI, and light PNG compression
+# keeps zlib from dominating the save
+CHART_DPI = 100
+PNG_OPTIONS = {"compress_level": 1}
+
+# savefig options per output format; SVG skips rasterizing and PNG encoding
+# entirely, PNG stays the default since the report embeds the images
+SAVE_OPTIONS = {
+    "png": {"dpi": CHART_DPI, "pil_kwargs": PNG_OPTIONS},
+    "svg": {}
+}
+
 # Set professional style
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams['figure.figsize'] = (12, 7)
@@ -46,9 +69,8 @@ COLORS = {
 # DATABASE CONNECTIONS
 # ============================================================
 def connect_mongodb():
-    connection_string = f"mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/"
-    client = MongoClient(connection_string)
-    db = client[MONGO_DB]
+    client = get_client()
+    db = client[DATABASE_NAME]
     return client, db
 
 
@@ -58,8 +80,14 @@ def connect_hbase():
             HBASE_HOST, 
             HBASE_PORT,
             timeout=30000,  # 30 second timeout
-            autoconnect=True
+            autoconnect=True,
+            transport=HBASE_TRANSPORT,
+            protocol=HBASE_PROTOCOL
         )
+        # Opening the socket succeeds even if the Thrift transport/protocol
+        # don't match the server; one RPC makes a mismatch fail here instead
+        # of silently sending the HBase charts to their fallback data
+        connection.tables()
         return connection
     except Exception as e:
         print(f"   Warning: Could not connect to HBase: {e}")
@@ -67,41 +95,183 @@ def connect_hbase():
 
 
 # ============================================================
-# CHART 1: TOP 10 CATEGORIES BY REVENUE (Horizontal Bar)
+# CHART OUTPUT
 # ============================================================
-def chart_revenue_by_category(mongo_db):
-    print(" Creating Chart 1: Revenue by Category...")
+def save_chart(name, fmt):
+    """Save and close the current figure, returning its path"""
+    filepath = os.path.join(OUTPUT_DIR, f"{name}.{fmt}")
+    plt.savefig(filepath, facecolor='white', **SAVE_OPTIONS[fmt])
+    plt.close()
+    return filepath
+
+
+# ============================================================
+# SHARED TRANSACTIONS SCAN (Charts 1, 2, 4, 5)
+# ============================================================
+def transaction_facets(mongo_db):
+    """
+    Compute the MongoDB data for charts 1, 2, 4 and 5 in a single scan of
+    transactions, one $facet sub-pipeline per chart.
+    """
+    print(" Aggregating transactions for charts 1, 2, 4, 5...")
     
     pipeline = [
-        {"$unwind": "$items"},
-        {"$lookup": {
-            "from": "products",
-            "localField": "items.product_id",
-            "foreignField": "product_id",
-            "as": "product"
-        }},
-        {"$unwind": "$product"},
-        {"$lookup": {
-            "from": "categories",
-            "localField": "product.category_id",
-            "foreignField": "category_id",
-            "as": "category"
+        # Only the fields some facet reads
+        {"$project": {
+            "_id": 0,
+            "user_id": 1,
+            "total": 1,
+            "month": 1,
+            "items.category_id": 1,
+            "items.product_id": 1,
+            "items.quantity": 1,
+            "items.subtotal": 1
         }},
-        {"$unwind": "$category"},
-        {"$group": {
-            "_id": "$category.name",
-            "revenue": {"$sum": "$items.subtotal"},
-            "orders": {"$sum": 1}
-        }},
-        {"$sort": {"revenue": -1}},
-        {"$limit": 10}
+        {"$facet": {
+            # Chart 1: items carry their category_id (set by the loader)
+            "by_category": [
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": "$items.category_id",
+                    "revenue": {"$sum": "$items.subtotal"}
+                }}
+            ],
+            # Chart 2: 100 equal-count buckets of per-user spending
+            "user_spending": [
+                {"$group": {
+                    "_id": "$user_id",
+                    "total_spent": {"$sum": "$total"}
+                }},
+                {"$bucketAuto": {
+                    "groupBy": "$total_spent",
+                    "buckets": 100,
+                    "output": {
+                        "count": {"$sum": 1},
+                        "total_spent": {"$sum": "$total_spent"}
+                    }
+                }}
+            ],
+            # Chart 4: month is stored by the loader as YYYY-MM
+            "by_month": [
+                {"$group": {
+                    "_id": "$month",
+                    "revenue": {"$sum": "$total"},
+                    "transactions": {"$sum": 1}
+                }},
+                {"$sort": {"_id": 1}}
+            ],
+            # Chart 5
+            "by_product": [
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": "$items.product_id",
+                    "total_quantity": {"$sum": "$items.quantity"},
+                    "total_revenue": {"$sum": "$items.subtotal"}
+                }},
+                {"$sort": {"total_quantity": -1}},
+                {"$limit": 10},
+                # Only the product name is drawn, so don't ship whole documents
+                {"$lookup": {
+                    "from": "products",
+                    "let": {"pid": "$_id"},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$product_id", "$$pid"]}}},
+                        {"$project": {"_id": 0, "name": 1}}
+                    ],
+                    "as": "product"
+                }},
+                {"$unwind": "$product"}
+            ]
+        }}
     ]
     
-    data = list(mongo_db.transactions.aggregate(pipeline))
+    facets = next(mongo_db.transactions.aggregate(pipeline, allowDiskUse=True))
+    
+    # Charts 1 and 4 group on fields mongodb_loader.py stores on each
+    # transaction; a database loaded by an older loader groups to None
+    if not facets['by_month']:
+        raise RuntimeError("No transactions in MongoDB; load them with mongodb_loader.py first")
+    if (any(m['_id'] is None for m in facets['by_month'])
+            or all(c['_id'] is None for c in facets['by_category'])):
+        raise RuntimeError(
+            "Transactions are missing the month / items.category_id fields the charts "
+            "group on (loaded by an older mongodb_loader.py); reload them with "
+            "`python mongodb_loader.py --full`"
+        )
+    return facets
+
+
+# ============================================================
+# SHARED SESSIONS SCAN (Charts 3, 6)
+# ============================================================
+def session_sample(hbase_conn):
+    """
+    Scan one sample of sessions for charts 3 and 6, keeping the raw cell
+    bytes both charts tally. Returns None if HBase is unavailable or the
+    scan comes back empty, so the charts fall back to sample data.
+    """
+    if not hbase_conn:
+        return None
+    
+    print(" Scanning HBase sessions for charts 3, 6...")
+    try:
+        table = hbase_conn.table('sessions')
+        
+        # Limit total records to avoid timeout; only the four cells the
+        # two charts read travel over Thrift
+        max_records = 10000
+        columns = [
+            b'session_info:conversion_status',
+            b'activity:page_views_count',
+            b'device:type',
+            b'session_info:referrer'
+        ]
+        
+        sample = {'status': [], 'page_views': [], 'device': [], 'referrer': []}
+        for key, data in scan_salted_sample(table, max_records, columns, batch_size=5000):
+            sample['status'].append(data.get(b'session_info:conversion_status', b''))
+            sample['page_views'].append(data.get(b'activity:page_views_count', b'0'))
+            sample['device'].append(data.get(b'device:type', b'unknown'))
+            sample['referrer'].append(data.get(b'session_info:referrer', b'unknown'))
+        
+        if not sample['status']:
+            raise Exception("No data retrieved")
+        return sample
+    
+    except Exception as e:
+        print(f"   Warning: HBase scan failed ({e}), using fallback data")
+        return None
+
+
+# ============================================================
+# CHART 1: TOP 10 CATEGORIES BY REVENUE (Horizontal Bar)
+# ============================================================
+def fetch_category_names(mongo_db):
+    """
+    Map category_id to name; categories is a small reference table, so it
+    is fetched once and the groups are named client-side instead of joining
+    per item on the server.
+    """
+    return {
+        c['category_id']: c['name']
+        for c in mongo_db.categories.find({}, {"_id": 0, "category_id": 1, "name": 1})
+    }
+
+
+def chart_revenue_by_category(category_revenue, category_names, fmt="png"):
+    print(" Creating Chart 1: Revenue by Category...")
+    
+    revenue_by_name = Counter()
+    for d in category_revenue:
+        if d['_id'] in category_names:
+            revenue_by_name[category_names[d['_id']]] += d['revenue']
+    data = revenue_by_name.most_common(10)
+    if not data:
+        raise RuntimeError("No category revenue matched a category name; load the categories collection")
     
     # Shorten category names if too long
-    categories = [d['_id'][:20] + '...' if len(d['_id']) > 20 else d['_id'] for d in data]
-    revenues = [d['revenue'] for d in data]
+    categories = [name[:20] + '...' if len(name) > 20 else name for name, _ in data]
+    revenues = [revenue for _, revenue in data]
     
     # Create figure
     fig, ax = plt.subplots(figsize=(12, 8))
@@ -134,9 +304,7 @@ def chart_revenue_by_category(mongo_db):
     
     plt.tight_layout()
     
-    filepath = os.path.join(OUTPUT_DIR, '1_revenue_by_category.png')
-    plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-    plt.close()
+    filepath = save_chart('1_revenue_by_category', fmt)
     
     print(f"    Saved: {filepath}")
     return filepath
@@ -145,69 +313,61 @@ def chart_revenue_by_category(mongo_db):
 # ============================================================
 # CHART 2: CUSTOMER SEGMENTS (Pie Charts)
 # ============================================================
-def chart_customer_segments(mongo_db):
+def percentiles_from_buckets(buckets, fractions):
+    """
+    Approximate percentiles from $bucketAuto output (sorted, equal-count
+    buckets): each value is the lower bound of the bucket holding that rank.
+    """
+    n = sum(b['count'] for b in buckets)
+    results = []
+    for fraction in fractions:
+        rank = int(n * fraction)
+        seen = 0
+        for b in buckets:
+            seen += b['count']
+            if seen > rank:
+                results.append(b['_id']['min'])
+                break
+        else:
+            results.append(buckets[-1]['_id']['max'])
+    return results
+
+
+def segments_from_buckets(buckets, p50, p75, p90):
+    """
+    Sum spending buckets into Platinum/Gold/Silver/Bronze. The thresholds
+    are bucket lower bounds, so every bucket falls wholly in one segment.
+    """
+    segments = {}
+    for b in buckets:
+        low = b['_id']['min']
+        if low >= p90:
+            name = 'Platinum'
+        elif low >= p75:
+            name = 'Gold'
+        elif low >= p50:
+            name = 'Silver'
+        else:
+            name = 'Bronze'
+        seg = segments.setdefault(name, {'_id': name, 'count': 0, 'total_revenue': 0})
+        seg['count'] += b['count']
+        seg['total_revenue'] += b['total_spent']
+    return segments
+
+
+def chart_customer_segments(spending_buckets, fmt="png"):
     print(" Creating Chart 2: Customer Segments...")
     
-    # First get spending distribution stats
-    stats_pipeline = [
-        {"$group": {
-            "_id": "$user_id",
-            "total_spent": {"$sum": "$total"}
-        }},
-        {"$group": {
-            "_id": None,
-            "values": {"$push": "$total_spent"}
-        }}
-    ]
-    
-    result = list(mongo_db.transactions.aggregate(stats_pipeline))[0]
-    spending_values = sorted(result['values'])
-    
-    # Calculate percentiles
-    n = len(spending_values)
-    p25 = spending_values[int(n * 0.25)]
-    p50 = spending_values[int(n * 0.50)]
-    p75 = spending_values[int(n * 0.75)]
-    p90 = spending_values[int(n * 0.90)]
+    # Calculate percentiles; 100 equal-count buckets give them to within
+    # one percentile without shipping every user's total
+    p25, p50, p75, p90 = percentiles_from_buckets(spending_buckets, [0.25, 0.50, 0.75, 0.90])
     
     # Segment customers using percentiles
-    segment_pipeline = [
-        {"$group": {
-            "_id": "$user_id",
-            "total_spent": {"$sum": "$total"},
-            "order_count": {"$sum": 1}
-        }},
-        {"$addFields": {
-            "segment": {
-                "$switch": {
-                    "branches": [
-                        {"case": {"$gte": ["$total_spent", p90]}, "then": "Platinum"},
-                        {"case": {"$gte": ["$total_spent", p75]}, "then": "Gold"},
-                        {"case": {"$gte": ["$total_spent", p50]}, "then": "Silver"}
-                    ],
-                    "default": "Bronze"
-                }
-            }
-        }},
-        {"$group": {
-            "_id": "$segment",
-            "count": {"$sum": 1},
-            "total_revenue": {"$sum": "$total_spent"},
-            "avg_orders": {"$avg": "$order_count"}
-        }},
-        {"$sort": {"total_revenue": -1}}
-    ]
-    
-    data = list(mongo_db.transactions.aggregate(segment_pipeline))
+    data = segments_from_buckets(spending_buckets, p50, p75, p90)
     
     # Order segments properly
     segment_order = ['Platinum', 'Gold', 'Silver', 'Bronze']
-    data_ordered = []
-    for seg in segment_order:
-        for d in data:
-            if d['_id'] == seg:
-                data_ordered.append(d)
-                break
+    data_ordered = [data[seg] for seg in segment_order if seg in data]
     
     segments = [d['_id'] for d in data_ordered]
     counts = [d['count'] for d in data_ordered]
@@ -219,35 +379,37 @@ def chart_customer_segments(mongo_db):
     # Create figure with 2 pie charts
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 7))
     
+    # Wedge labels are built up front rather than through an autopct
+    # callback, and the pies are drawn flat (no shadow pass, no explode)
+    total_count = sum(counts)
+    total_revenue = sum(revenues)
+    count_labels = [f'{seg}\n{c / total_count * 100:.1f}%\n({c:,})' for seg, c in zip(segments, counts)]
+    revenue_labels = [f'{seg}\n{r / total_revenue * 100:.1f}%\n(${r:,.0f})' for seg, r in zip(segments, revenues)]
+    
     # Pie chart 1 - Customer Count
-    explode = [0.03, 0.02, 0.01, 0]
-    wedges1, texts1, autotexts1 = ax1.pie(
+    wedges1, texts1 = ax1.pie(
         counts, 
-        labels=segments, 
+        labels=count_labels, 
         colors=colors,
-        autopct=lambda pct: f'{pct:.1f}%\n({int(pct/100*sum(counts)):,})',
         startangle=90,
-        explode=explode,
-        shadow=True
+        shadow=False
     )
-    for autotext in autotexts1:
-        autotext.set_fontsize(10)
-        autotext.set_fontweight('bold')
+    for text in texts1:
+        text.set_fontsize(10)
+        text.set_fontweight('bold')
     ax1.set_title('Customer Distribution\nby Segment', fontsize=14, fontweight='bold')
     
     # Pie chart 2 - Revenue
-    wedges2, texts2, autotexts2 = ax2.pie(
+    wedges2, texts2 = ax2.pie(
         revenues, 
-        labels=segments, 
+        labels=revenue_labels, 
         colors=colors,
-        autopct=lambda pct: f'{pct:.1f}%\n(${int(pct/100*sum(revenues)):,})',
         startangle=90,
-        explode=explode,
-        shadow=True
+        shadow=False
     )
-    for autotext in autotexts2:
-        autotext.set_fontsize(10)
-        autotext.set_fontweight('bold')
+    for text in texts2:
+        text.set_fontsize(10)
+        text.set_fontweight('bold')
     ax2.set_title('Revenue Distribution\nby Segment', fontsize=14, fontweight='bold')
     
     # Add legend with thresholds
@@ -258,9 +420,7 @@ def chart_customer_segments(mongo_db):
     plt.tight_layout()
     plt.subplots_adjust(bottom=0.15)
     
-    filepath = os.path.join(OUTPUT_DIR, '2_customer_segments.png')
-    plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-    plt.close()
+    filepath = save_chart('2_customer_segments', fmt)
     
     print(f"    Saved: {filepath}")
     return filepath
@@ -269,58 +429,23 @@ def chart_customer_segments(mongo_db):
 # ============================================================
 # CHART 3: CONVERSION FUNNEL
 # ============================================================
-def chart_conversion_funnel(hbase_conn):
+def chart_conversion_funnel(sessions, fmt="png"):
     print(" Creating Chart 3: Conversion Funnel...")
     
-    # Get data from HBase
-    total_sessions = 0
-    sessions_with_views = 0
-    sessions_with_cart = 0
-    converted_sessions = 0
-    
-    if hbase_conn:
-        try:
-            table = hbase_conn.table('sessions')
-            
-            # Scan in smaller batches to avoid timeout
-            batch_size = 1000
-            max_records = 10000  # Limit total records to avoid timeout
-            
-            for key, data in table.scan(batch_size=batch_size):
-                if total_sessions >= max_records:
-                    break
-                    
-                total_sessions += 1
-                
-                status = data.get(b'session_info:conversion_status', b'').decode()
-                page_views = int(data.get(b'activity:page_views_count', b'0').decode() or 0)
-                
-                if page_views > 1:
-                    sessions_with_views += 1
-                
-                if status in ['abandoned', 'converted']:
-                    sessions_with_cart += 1
-                
-                if status == 'converted':
-                    converted_sessions += 1
-            
-            # If we got data, scale it up proportionally to represent full dataset
-            if total_sessions > 0:
-                scale_factor = 100000 / total_sessions
-                total_sessions = int(total_sessions * scale_factor)
-                sessions_with_views = int(sessions_with_views * scale_factor)
-                sessions_with_cart = int(sessions_with_cart * scale_factor)
-                converted_sessions = int(converted_sessions * scale_factor)
-            else:
-                raise Exception("No data retrieved")
-                
-        except Exception as e:
-            print(f"   Warning: HBase scan failed ({e}), using fallback data")
-            # Fallback data
-            total_sessions = 100000
-            sessions_with_views = 90000
-            sessions_with_cart = 30000
-            converted_sessions = 10000
+    if sessions:
+        # Tally the raw status bytes in C rather than branching per session
+        status_counts = Counter(sessions['status'])
+        total_sessions = len(sessions['status'])
+        sessions_with_views = sum(int(v or 0) > 1 for v in sessions['page_views'])
+        sessions_with_cart = status_counts[b'abandoned'] + status_counts[b'converted']
+        converted_sessions = status_counts[b'converted']
+        
+        # Scale the sample up proportionally to represent full dataset
+        scale_factor = 100000 / total_sessions
+        total_sessions = int(total_sessions * scale_factor)
+        sessions_with_views = int(sessions_with_views * scale_factor)
+        sessions_with_cart = int(sessions_with_cart * scale_factor)
+        converted_sessions = int(converted_sessions * scale_factor)
     else:
         # Fallback data
         total_sessions = 100000
@@ -379,9 +504,7 @@ def chart_conversion_funnel(hbase_conn):
     
     plt.tight_layout()
     
-    filepath = os.path.join(OUTPUT_DIR, '3_conversion_funnel.png')
-    plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-    plt.close()
+    filepath = save_chart('3_conversion_funnel', fmt)
     
     print(f"    Saved: {filepath}")
     return filepath
@@ -390,23 +513,10 @@ def chart_conversion_funnel(hbase_conn):
 # ============================================================
 # CHART 4: MONTHLY REVENUE TREND (Line Chart)
 # ============================================================
-def chart_monthly_revenue(mongo_db):
+def chart_monthly_revenue(monthly_revenue, fmt="png"):
     print(" Creating Chart 4: Monthly Revenue Trend...")
     
-    pipeline = [
-        {"$addFields": {
-            "month": {"$substr": ["$timestamp", 0, 7]}
-        }},
-        {"$group": {
-            "_id": "$month",
-            "revenue": {"$sum": "$total"},
-            "transactions": {"$sum": 1},
-            "avg_order": {"$avg": "$total"}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    
-    data = list(mongo_db.transactions.aggregate(pipeline))
+    data = monthly_revenue
     
     months = [d['_id'] for d in data]
     revenues = [d['revenue'] for d in data]
@@ -459,9 +569,7 @@ def chart_monthly_revenue(mongo_db):
     
     plt.tight_layout()
     
-    filepath = os.path.join(OUTPUT_DIR, '4_monthly_revenue_trend.png')
-    plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-    plt.close()
+    filepath = save_chart('4_monthly_revenue_trend', fmt)
     
     print(f"    Saved: {filepath}")
     return filepath
@@ -470,28 +578,10 @@ def chart_monthly_revenue(mongo_db):
 # ============================================================
 # CHART 5: TOP 10 PRODUCTS BY SALES
 # ============================================================
-def chart_top_products(mongo_db):
+def chart_top_products(top_products, fmt="png"):
     print(" Creating Chart 5: Top Products by Sales...")
     
-    pipeline = [
-        {"$unwind": "$items"},
-        {"$group": {
-            "_id": "$items.product_id",
-            "total_quantity": {"$sum": "$items.quantity"},
-            "total_revenue": {"$sum": "$items.subtotal"}
-        }},
-        {"$sort": {"total_quantity": -1}},
-        {"$limit": 10},
-        {"$lookup": {
-            "from": "products",
-            "localField": "_id",
-            "foreignField": "product_id",
-            "as": "product"
-        }},
-        {"$unwind": "$product"}
-    ]
-    
-    data = list(mongo_db.transactions.aggregate(pipeline))
+    data = top_products
     
     # Get product names (shortened)
     products = [d['product']['name'][:18] + '...' if len(d['product']['name']) > 18 
@@ -533,9 +623,7 @@ def chart_top_products(mongo_db):
     
     plt.tight_layout()
     
-    filepath = os.path.join(OUTPUT_DIR, '5_top_products.png')
-    plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-    plt.close()
+    filepath = save_chart('5_top_products', fmt)
     
     print(f"    Saved: {filepath}")
     return filepath
@@ -544,61 +632,26 @@ def chart_top_products(mongo_db):
 # ============================================================
 # CHART 6: DEVICE & REFERRER PERFORMANCE
 # ============================================================
-def chart_device_referrer_performance(hbase_conn):
+def tally_conversions(values_raw, converted):
+    """
+    Count sessions and conversions per raw HBase cell value; Counter tallies
+    the bytes in C and only the handful of distinct keys get decoded.
+    """
+    totals = Counter(values_raw)
+    conversions = Counter(itertools.compress(values_raw, converted))
+    return {
+        value.decode(): {'total': total, 'converted': conversions[value]}
+        for value, total in totals.items()
+    }
+
+
+def chart_device_referrer_performance(sessions, fmt="png"):
     print(" Creating Chart 6: Device & Referrer Performance...")
     
-    device_stats = {}
-    referrer_stats = {}
-    
-    if hbase_conn:
-        try:
-            table = hbase_conn.table('sessions')
-            
-            # Scan in smaller batches to avoid timeout
-            batch_size = 1000
-            max_records = 10000
-            record_count = 0
-            
-            for key, data in table.scan(batch_size=batch_size):
-                if record_count >= max_records:
-                    break
-                record_count += 1
-                
-                device = data.get(b'device:type', b'unknown').decode()
-                referrer = data.get(b'session_info:referrer', b'unknown').decode()
-                status = data.get(b'session_info:conversion_status', b'').decode()
-                
-                # Device stats
-                if device not in device_stats:
-                    device_stats[device] = {'total': 0, 'converted': 0}
-                device_stats[device]['total'] += 1
-                if status == 'converted':
-                    device_stats[device]['converted'] += 1
-                
-                # Referrer stats
-                if referrer not in referrer_stats:
-                    referrer_stats[referrer] = {'total': 0, 'converted': 0}
-                referrer_stats[referrer]['total'] += 1
-                if status == 'converted':
-                    referrer_stats[referrer]['converted'] += 1
-            
-            # If no data retrieved, use fallback
-            if not device_stats:
-                raise Exception("No data retrieved")
-                
-        except Exception as e:
-            print(f"   Warning: HBase scan failed ({e}), using fallback data")
-            device_stats = {
-                'desktop': {'total': 35000, 'converted': 4000},
-                'mobile': {'total': 40000, 'converted': 3500},
-                'tablet': {'total': 25000, 'converted': 2500}
-            }
-            referrer_stats = {
-                'google': {'total': 30000, 'converted': 3500},
-                'facebook': {'total': 25000, 'converted': 2500},
-                'direct': {'total': 20000, 'converted': 2000},
-                'other': {'total': 25000, 'converted': 2000}
-            }
+    if sessions:
+        converted = [status == b'converted' for status in sessions['status']]
+        device_stats = tally_conversions(sessions['device'], converted)
+        referrer_stats = tally_conversions(sessions['referrer'], converted)
     else:
         device_stats = {
             'desktop': {'total': 35000, 'converted': 4000},
@@ -654,18 +707,79 @@ def chart_device_referrer_performance(hbase_conn):
     
     plt.tight_layout()
     
-    filepath = os.path.join(OUTPUT_DIR, '6_device_referrer_performance.png')
-    plt.savefig(filepath, dpi=150, bbox_inches='tight', facecolor='white')
-    plt.close()
+    filepath = save_chart('6_device_referrer_performance', fmt)
     
     print(f"    Saved: {filepath}")
     return filepath
 
 
+# ============================================================
+# CHART CACHE
+# ============================================================
+def mongo_data_version(mongo_db):
+    """
+    Fingerprint the collections behind charts 1, 2, 4 and 5. The loader only
+    ever inserts (or upserts with $setOnInsert), so any load changes either
+    the document count or the newest _id.
+    """
+    version = {}
+    for name in ('transactions', 'products', 'categories'):
+        newest = mongo_db[name].find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        version[name] = [
+            mongo_db[name].estimated_document_count(),
+            str(newest['_id']) if newest else None
+        ]
+    return version
+
+
+def load_chart_cache():
+    """Data version each output format was last drawn from, keyed by format"""
+    try:
+        with open(CHART_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def cached_mongo_charts(version, fmt):
+    """Return the saved chart paths if this format was drawn from this data version"""
+    paths = [os.path.join(OUTPUT_DIR, f"{name}.{fmt}") for name in MONGO_CHARTS]
+    if load_chart_cache().get(fmt) == version and all(os.path.exists(p) for p in paths):
+        return paths
+    return None
+
+
+def save_chart_cache(version, fmt):
+    """Record the data version for fmt only; other formats keep their own stamp"""
+    cache = load_chart_cache()
+    cache[fmt] = version
+    with open(CHART_CACHE_FILE, 'w') as f:
+        json.dump(cache, f)
+
+
 # ============================================================
 # MAIN FUNCTION
 # ============================================================
+def run_session_scan():
+    """Scan the sessions sample in a worker process, on its own connection"""
+    # Thrift connections can't be shared across processes
+    hbase_conn = connect_hbase()
+    try:
+        return session_sample(hbase_conn)
+    finally:
+        if hbase_conn:
+            hbase_conn.close()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Generate the report charts")
+    parser.add_argument('--force', action='store_true',
+                        help="Redraw every chart even if the MongoDB data is unchanged")
+    parser.add_argument('--format', choices=sorted(SAVE_OPTIONS), default='png',
+                        help="Chart file format (default: png)")
+    args = parser.parse_args()
+    
     print("\n" + "=" * 60)
     print("   E-COMMERCE ANALYTICS - FINAL VISUALIZATIONS")
     print("=" * 60 + "\n")
@@ -674,41 +788,71 @@ def main():
     print("Connecting to databases...")
     mongo_client, mongo_db = connect_mongodb()
     hbase_conn = connect_hbase()
+    use_hbase = hbase_conn is not None
     print(f" MongoDB connected")
-    print(f"{'' if hbase_conn else ' '} HBase {'connected' if hbase_conn else 'not available'}\n")
+    print(f"{'' if use_hbase else ' '} HBase {'connected' if use_hbase else 'not available'}\n")
+    if hbase_conn:
+        hbase_conn.close()
     
     # Generate all charts
     print("Generating visualizations...\n")
     
-    charts = []
-    charts.append(chart_revenue_by_category(mongo_db))
-    charts.append(chart_customer_segments(mongo_db))
-    charts.append(chart_conversion_funnel(hbase_conn))
-    charts.append(chart_monthly_revenue(mongo_db))
-    charts.append(chart_top_products(mongo_db))
-    charts.append(chart_device_referrer_performance(hbase_conn))
-    
-    # Summary
-    print("\n" + "=" * 60)
-    print(" ALL VISUALIZATIONS COMPLETE!")
-    print("=" * 60)
-    print(f"\n Saved to: {OUTPUT_DIR}")
-    print("\nCharts created:")
-    for i, chart in enumerate(charts, 1):
-        print(f"   {i}. {os.path.basename(chart)}")
-    
-    print("\n Chart Descriptions:")
-    print("   1. Revenue by Category - Top 10 categories by total revenue")
-    print("   2. Customer Segments - Distribution by spending percentiles")
-    print("   3. Conversion Funnel - User journey from session to purchase")
-    print("   4. Monthly Revenue Trend - Revenue and transactions over time")
-    print("   5. Top Products - Best selling products by volume")
-    print("   6. Device & Referrer - Conversion rates by source")
-    
-    # Cleanup
-    mongo_client.close()
-    if hbase_conn:
-        hbase_conn.close()
+    # Each chart draws its own figure, so render them in parallel processes
+    # (matplotlib holds the GIL). Charts 3 and 6 share one sessions scan,
+    # submitted first so it overlaps the MongoDB queries. The client is
+    # closed on the way out of the block, even if a chart fails
+    with mongo_client, ProcessPoolExecutor(max_workers=6) as pool:
+        # Without HBase there is nothing to scan, so don't tie up a worker
+        if use_hbase:
+            sessions_scan = pool.submit(run_session_scan)
+        else:
+            print(" HBase not available, charts 3 and 6 use sample data")
+            sessions_scan = None
+        
+        version = mongo_data_version(mongo_db)
+        cached = None if args.force else cached_mongo_charts(version, args.format)
+        if cached:
+            print(" MongoDB data unchanged, reusing charts 1, 2, 4 and 5")
+            revenue, segments, monthly, top = cached
+        else:
+            facets = transaction_facets(mongo_db)
+            category_names = fetch_category_names(mongo_db)
+            revenue = pool.submit(chart_revenue_by_category, facets['by_category'], category_names, fmt=args.format)
+            segments = pool.submit(chart_customer_segments, facets['user_spending'], fmt=args.format)
+            monthly = pool.submit(chart_monthly_revenue, facets['by_month'], fmt=args.format)
+            top = pool.submit(chart_top_products, facets['by_product'], fmt=args.format)
+        
+        sessions = sessions_scan.result() if sessions_scan else None
+        funnel = pool.submit(chart_conversion_funnel, sessions, fmt=args.format)
+        device_referrer = pool.submit(chart_device_referrer_performance, sessions, fmt=args.format)
+        
+        charts = [
+            chart if isinstance(chart, str) else chart.result()
+            for chart in (revenue, segments, funnel, monthly, top, device_referrer)
+        ]
+    
+    if not cached:
+        save_chart_cache(version, args.format)
+    
+    # Summary, written in one call so it comes out as a single block
+    summary = [
+        "\n" + "=" * 60,
+        " ALL VISUALIZATIONS COMPLETE!",
+        "=" * 60,
+        f"\n Saved to: {OUTPUT_DIR}",
+        "\nCharts created:"
+    ]
+    summary += [f"   {i}. {os.path.basename(chart)}" for i, chart in enumerate(charts, 1)]
+    summary += [
+        "\n Chart Descriptions:",
+        "   1. Revenue by Category - Top 10 categories by total revenue",
+        "   2. Customer Segments - Distribution by spending percentiles",
+        "   3. Conversion Funnel - User journey from session to purchase",
+        "   4. Monthly Revenue Trend - Revenue and transactions over time",
+        "   5. Top Products - Best selling products by volume",
+        "   6. Device & Referrer - Conversion rates by source"
+    ]
+    print("\n".join(summary))
     
     print("\n Done! Charts are ready for your report.")
 